@@ -12,9 +12,11 @@ urlpatterns = [
     path('auth/forgot-password/', views.ForgotPasswordView.as_view(), name='forgot-password'),
     path('auth/reset-password/', views.ResetPasswordView.as_view(), name='reset-password'),
     path('auth/verify-session/', views.VerifySessionView.as_view(), name='verify-session'),
+    path('sidebar/bundle/', views.SidebarBundleView.as_view(), name='sidebar-bundle'),
     
     # Chat endpoints
     path('chat/send/', views.ChatSendView.as_view(), name='chat-send'),
+    path('chat/send/stream/', views.ChatSendStreamView.as_view(), name='chat-send-stream'),
     path('chat/sessions/', views.ChatSessionsView.as_view(), name='chat-sessions'),
     path('chat/sessions/create/', views.CreateChatSessionView.as_view(), name='create-chat-session'),
     path('chat/history/<str:session_id>/', views.ChatHistoryView.as_view(), name='chat-history'),
@@ -9,6 +9,7 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.conf import settings
+from django.http import StreamingHttpResponse
 
 from utils.database import Database
 from utils.auth import AuthManager
@@ -76,11 +77,8 @@ def get_llm_client():
 llm_client, llm_provider, llm_model = get_llm_client()
 
 
-def generate_answer(query: str, context_chunks: list, selected_file: str = None) -> str:
-    """Sinh câu trả lời từ LLM dựa trên context"""
-    if not context_chunks:
-        return "Trong các tài liệu đã upload chưa có thông tin về nội dung này."
-    
+def _build_answer_prompt(query: str, context_chunks: list, selected_file: str = None):
+    """Ghép context và dựng prompt trả lời. Returns: (prompt, context_text)"""
     context_by_file = {}
     for chunk in context_chunks:
         filename = chunk['filename']
@@ -150,7 +148,16 @@ YÊU CẦU TRẢ LỜI (QUAN TRỌNG - PHẢI TUÂN THỦ):
 
 Hãy trả lời một cách chi tiết, đầy đủ và có định dạng đẹp:
 """
-    
+    return prompt, context_text
+
+
+def generate_answer(query: str, context_chunks: list, selected_file: str = None) -> str:
+    """Sinh câu trả lời từ LLM dựa trên context"""
+    if not context_chunks:
+        return "Trong các tài liệu đã upload chưa có thông tin về nội dung này."
+
+    prompt, context_text = _build_answer_prompt(query, context_chunks, selected_file)
+
     if llm_client is None:
         return f"""⚠️ Chưa cấu hình LLM API key. Đây là thông tin tìm được từ tài liệu:
 
@@ -228,6 +235,45 @@ Vui lòng thêm GROQ_API_KEY vào file .env để chatbot có thể trả lời
         return f"⚠️ Lỗi khi tạo câu trả lời: {str(e)}\n\nThông tin từ tài liệu:\n\n{context_text}"
 
 
+def generate_answer_stream(query: str, context_chunks: list, selected_file: str = None):
+    """
+    Bản streaming của generate_answer: yield từng delta text từ LLM
+    để client render dần. Trường hợp không stream được (chưa cấu hình
+    client, lỗi API) thì yield một chuỗi duy nhất rồi kết thúc.
+    """
+    if not context_chunks:
+        yield "Trong các tài liệu đã upload chưa có thông tin về nội dung này."
+        return
+
+    prompt, context_text = _build_answer_prompt(query, context_chunks, selected_file)
+
+    if llm_client is None:
+        yield f"""⚠️ Chưa cấu hình LLM API key. Đây là thông tin tìm được từ tài liệu:
+
+{context_text}
+
+Vui lòng thêm GROQ_API_KEY vào file .env để chatbot có thể trả lời tự động."""
+        return
+
+    try:
+        # max_tokens cao ngay từ đầu vì khi stream không còn bước
+        # phát hiện câu trả lời cắt cụt + retry như bản non-stream
+        stream = llm_client.chat.completions.create(
+            model=llm_model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.1,
+            max_tokens=8192,
+            stream=True,
+        )
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    except Exception as e:
+        logger.error(f"Lỗi khi stream LLM: {str(e)}")
+        yield f"⚠️ Lỗi khi tạo câu trả lời: {str(e)}\n\nThông tin từ tài liệu:\n\n{context_text}"
+
+
 def is_meaningless_query_ai(query: str) -> bool:
     """
     Sử dụng AI để nhận định câu hỏi có vô nghĩa hay không
@@ -339,6 +385,108 @@ def get_session_id_from_request(request):
     return token
 
 
+def build_files_payload(user_id):
+    """
+    Ghép thông tin file từ database và vector store thành payload danh sách file.
+    Dùng chung cho FileListView và SidebarBundleView.
+    """
+    user_files = database.get_user_files(user_id)
+    stats = vector_store.get_stats(user_id=user_id)
+
+    if not user_files:
+        return {
+            "success": True,
+            "message": "Chưa có file nào được upload.",
+            "files": [],
+            "total_files": 0,
+            "total_chunks": 0
+        }
+
+    files_list = []
+    for file_info in user_files:
+        filename = file_info['filename']
+        mongo_chunks = file_info.get('total_chunks', 0)
+        vector_chunks = stats['files'].get(filename, 0)
+        chunks_count = mongo_chunks if mongo_chunks > 0 else vector_chunks
+        files_list.append({
+            "filename": filename,
+            "chunks": chunks_count,
+            "cloudinary_url": file_info.get('cloudinary_url'),
+            "uploaded_at": file_info.get('uploaded_at')
+        })
+
+    return {
+        "success": True,
+        "files": files_list,
+        "total_files": len(files_list),
+        "total_chunks": stats['total_chunks']
+    }
+
+
+def build_sessions_payload(user_id):
+    """
+    Danh sách chat sessions đã format thời gian VN.
+    Dùng chung cho ChatSessionsView và SidebarBundleView.
+    """
+    from datetime import datetime, timedelta
+
+    sessions = database.get_chat_sessions(user_id)
+    if not sessions:
+        return {"success": True, "sessions": []}
+
+    result_sessions = []
+    for session in sessions:
+        # Kiểm tra xem session có messages không
+        last_message = database.get_last_message_of_session(session["session_id"])
+        if not last_message:
+            # Bỏ qua session không có messages
+            continue
+
+        utc_time = datetime.fromisoformat(session["updated_at"].replace("Z", "+00:00"))
+        vn_time = utc_time + timedelta(hours=7)
+        updated_time = vn_time.strftime("%d/%m/%Y %H:%M")
+
+        last_question = last_message["message"] if last_message.get("message") else "Chưa có câu hỏi nào"
+
+        result_sessions.append({
+            "session_id": session["session_id"],
+            "title": session.get("title", "Cuộc trò chuyện mới"),
+            "updated_at": updated_time,
+            "last_question": last_question[:90] + "..." if len(last_question) > 90 else last_question
+        })
+
+    return {"success": True, "sessions": result_sessions}
+
+
+def build_history_payload(chat_session_id):
+    """
+    Lịch sử chat của một session đã tách message/response thành role riêng.
+    Dùng chung cho ChatHistoryView và SidebarBundleView.
+    """
+    messages = database.get_session_messages(chat_session_id)
+    formatted_messages = []
+    for msg in messages:
+        user_msg = msg.get("message")
+        assistant_msg = msg.get("response")
+        created_at = msg.get("created_at") or msg.get("timestamp")
+
+        if user_msg:
+            formatted_messages.append({
+                "role": "user",
+                "content": user_msg,
+                "created_at": created_at
+            })
+
+        if assistant_msg:
+            formatted_messages.append({
+                "role": "assistant",
+                "content": assistant_msg,
+                "created_at": created_at
+            })
+
+    return {"success": True, "messages": formatted_messages}
+
+
 class LoginView(APIView):
     """API endpoint cho đăng nhập"""
     
@@ -550,6 +698,53 @@ class VerifySessionView(APIView):
                 "valid": False
             }, status=status.HTTP_200_OK)
 
+
+class SidebarBundleView(APIView):
+    """
+    API endpoint gộp verify-session + danh sách files + chat sessions
+    thành một request duy nhất: 1 RTT và 1 lần verify thay vì 3.
+    """
+
+    def post(self, request):
+        session_id = get_session_id_from_request(request)
+
+        if not session_id or not auth_manager:
+            return Response({
+                "success": False,
+                "valid": False
+            }, status=status.HTTP_200_OK)
+
+        user = auth_manager.get_user_from_session(session_id)
+        if not user or not database:
+            return Response({
+                "success": False,
+                "valid": False
+            }, status=status.HTTP_200_OK)
+
+        chat_session_id = database.create_chat_session(user["user_id"])
+
+        payload = {
+            "success": True,
+            "verify": {
+                "success": True,
+                "valid": True,
+                "user": user,
+                "chat_session_id": chat_session_id
+            },
+            "files": build_files_payload(user["user_id"]),
+            "sessions": build_sessions_payload(user["user_id"])
+        }
+
+        # Client đang chờ load lịch sử một session cụ thể thì gộp luôn
+        # messages vào bundle, khỏi tốn thêm một roundtrip riêng
+        load_chat_session_id = request.data.get('load_chat_session_id')
+        if load_chat_session_id:
+            payload["history"] = build_history_payload(load_chat_session_id)
+
+        resp = Response(payload, status=status.HTTP_200_OK)
+        return set_auth_cookie(resp, session_id)
+
+
 class ChatSendView(APIView):
     """API endpoint để gửi tin nhắn chat"""
     
@@ -672,6 +867,95 @@ class ChatSendView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class ChatSendStreamView(APIView):
+    """
+    Bản streaming của ChatSendView: trả NDJSON, mỗi dòng một object
+    {"delta": ...} khi LLM sinh thêm text, kết thúc bằng
+    {"done": true, "chat_session_id": ...}. Các nhánh trả lời ngắn
+    (câu vô nghĩa, câu giao tiếp, chưa có tài liệu) chỉ có một delta.
+    """
+
+    def post(self, request):
+        message = request.data.get('message', '').strip()
+        session_id = get_session_id_from_request(request)
+        selected_file = request.data.get('selected_file')
+        chat_session_id = request.data.get('chat_session_id')
+
+        if not message:
+            return Response(
+                {"success": False, "message": "Vui lòng nhập câu hỏi"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        def ndjson(obj):
+            return json.dumps(obj, ensure_ascii=False) + "\n"
+
+        def event_stream():
+            chat_sid = chat_session_id
+            user = auth_manager.get_user_from_session(session_id) if (session_id and auth_manager) else None
+            user_id = user["user_id"] if user else None
+
+            def save(answer):
+                nonlocal chat_sid
+                if user and database:
+                    if not chat_sid:
+                        chat_sid = database.create_chat_session(user["user_id"])
+                    database.save_chat_message(user["user_id"], message, answer, selected_file, chat_sid)
+                    if chat_sid:
+                        database.update_session(chat_sid, title=message)
+
+            try:
+                if is_meaningless_query_ai(message):
+                    answer = get_meaningless_response()
+                    save(answer)
+                    yield ndjson({"delta": answer})
+                    yield ndjson({"done": True, "chat_session_id": chat_sid})
+                    return
+
+                natural_response = get_natural_response(message)
+                if natural_response:
+                    save(natural_response)
+                    yield ndjson({"delta": natural_response})
+                    yield ndjson({"done": True, "chat_session_id": chat_sid})
+                    return
+
+                stats = vector_store.get_stats(user_id=user_id)
+                if stats["total_chunks"] == 0:
+                    yield ndjson({"delta": "⚠️ Chưa có tài liệu nào được upload. Vui lòng upload file PDF trước khi đặt câu hỏi."})
+                    yield ndjson({"done": True, "chat_session_id": chat_sid})
+                    return
+
+                search_results = vector_store.search(message, top_k=30, filename=selected_file, user_id=user_id)
+                if not search_results and selected_file:
+                    logger.warning(f"Không tìm thấy kết quả với file '{selected_file}'. Đang thử tìm trên tất cả file...")
+                    search_results = vector_store.search(message, top_k=30, filename=None, user_id=user_id)
+
+                if not search_results:
+                    response = "Không tìm thấy thông tin liên quan trong các tài liệu đã upload."
+                    if selected_file:
+                        response += f" (đã tìm trong file: {selected_file})"
+                    save(response)
+                    yield ndjson({"delta": response})
+                    yield ndjson({"done": True, "chat_session_id": chat_sid})
+                    return
+
+                expanded_results = vector_store.get_adjacent_chunks(search_results, page_range=2)
+                reranked_results = reranker.rerank(message, expanded_results, top_k=15)
+
+                parts = []
+                for delta in generate_answer_stream(message, reranked_results, selected_file):
+                    parts.append(delta)
+                    yield ndjson({"delta": delta})
+
+                save(''.join(parts))
+                yield ndjson({"done": True, "chat_session_id": chat_sid})
+            except Exception as e:
+                logger.error(f"Lỗi khi stream câu trả lời: {str(e)}")
+                yield ndjson({"error": f"Lỗi: {str(e)}"})
+
+        return StreamingHttpResponse(event_stream(), content_type="application/x-ndjson")
+
+
 class ChatSessionsView(APIView):
     """API endpoint để lấy danh sách chat sessions"""
     
@@ -691,40 +975,7 @@ class ChatSessionsView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        sessions = database.get_chat_sessions(user["user_id"])
-        if not sessions:
-            return Response({
-                "success": True,
-                "sessions": []
-            }, status=status.HTTP_200_OK)
-        
-        from datetime import datetime, timedelta
-        
-        result_sessions = []
-        for session in sessions:
-            # Kiểm tra xem session có messages không
-            last_message = database.get_last_message_of_session(session["session_id"])
-            if not last_message:
-                # Bỏ qua session không có messages
-                continue
-            
-            utc_time = datetime.fromisoformat(session["updated_at"].replace("Z", "+00:00"))
-            vn_time = utc_time + timedelta(hours=7)
-            updated_time = vn_time.strftime("%d/%m/%Y %H:%M")
-            
-            last_question = last_message["message"] if last_message.get("message") else "Chưa có câu hỏi nào"
-            
-            result_sessions.append({
-                "session_id": session["session_id"],
-                "title": session.get("title", "Cuộc trò chuyện mới"),
-                "updated_at": updated_time,
-                "last_question": last_question[:90] + "..." if len(last_question) > 90 else last_question
-            })
-        
-        return Response({
-            "success": True,
-            "sessions": result_sessions
-        }, status=status.HTTP_200_OK)
+        return Response(build_sessions_payload(user["user_id"]), status=status.HTTP_200_OK)
 
 class CreateChatSessionView(APIView):
     """API endpoint để tạo chat session mới"""
@@ -777,31 +1028,7 @@ class ChatHistoryView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        messages = database.get_session_messages(session_id)
-        formatted_messages = []
-        for msg in messages:
-            user_msg = msg.get("message")
-            assistant_msg = msg.get("response")
-            created_at = msg.get("created_at") or msg.get("timestamp")
-            
-            if user_msg:
-                formatted_messages.append({
-                    "role": "user",
-                    "content": user_msg,
-                    "created_at": created_at
-                })
-            
-            if assistant_msg:
-                formatted_messages.append({
-                    "role": "assistant",
-                    "content": assistant_msg,
-                    "created_at": created_at
-                })
-        
-        return Response({
-            "success": True,
-            "messages": formatted_messages
-        }, status=status.HTTP_200_OK)
+        return Response(build_history_payload(session_id), status=status.HTTP_200_OK)
 
 class FileUploadView(APIView):
     """API endpoint để upload file PDF lên Cloudinary"""
@@ -1053,7 +1280,11 @@ class FileUploadView(APIView):
                     "files_processed": len(uploaded_files_info),
                     "files_with_text": len(files_with_text),
                     "files_without_text": len(files_without_text),
-                    "warning": True
+                    "warning": True,
+                    # Server đã commit xong trước khi trả lời - client khỏi poll
+                    "indexed": True,
+                    # Kèm luôn danh sách file mới để client không phải poll lại
+                    "files": build_files_payload(user_id)
                 }, status=status.HTTP_200_OK)
             
             total_pages = sum(pages_info.values())
@@ -1066,7 +1297,11 @@ class FileUploadView(APIView):
                 "message": f"Đã xử lý xong {len(uploaded_files_info)} tài liệu, tổng cộng {total_pages} trang",
                 "files_processed": len(uploaded_files_info),
                 "total_pages": total_pages,
-                "files_detail": files_summary
+                "files_detail": files_summary,
+                # Server đã commit xong trước khi trả lời - client khỏi poll
+                "indexed": True,
+                # Kèm luôn danh sách file mới để client không phải poll lại
+                "files": build_files_payload(user_id)
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
@@ -1095,43 +1330,7 @@ class FileListView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        user_id = user["user_id"]
-        
-        # Lấy files từ database (có Cloudinary URL)
-        user_files = database.get_user_files(user_id)
-        
-        # Lấy stats từ vector store để có số chunks
-        stats = vector_store.get_stats(user_id=user_id)
-        
-        if not user_files:
-            return Response({
-                "success": True,
-                "message": "Chưa có file nào được upload.",
-                "files": [],
-                "total_files": 0,
-                "total_chunks": 0
-            }, status=status.HTTP_200_OK)
-        
-        # Kết hợp thông tin từ database và vector store
-        files_list = []
-        for file_info in user_files:
-            filename = file_info['filename']
-            mongo_chunks = file_info.get('total_chunks', 0)
-            vector_chunks = stats['files'].get(filename, 0)
-            chunks_count = mongo_chunks if mongo_chunks > 0 else vector_chunks
-            files_list.append({
-                "filename": filename,
-                "chunks": chunks_count,
-                "cloudinary_url": file_info.get('cloudinary_url'),
-                "uploaded_at": file_info.get('uploaded_at')
-            })
-        
-        return Response({
-            "success": True,
-            "files": files_list,
-            "total_files": len(files_list),
-            "total_chunks": stats['total_chunks']
-        }, status=status.HTTP_200_OK)
+        return Response(build_files_payload(user["user_id"]), status=status.HTTP_200_OK)
 
 
 class FileDeleteView(APIView):
@@ -1,7 +1,11 @@
+import io
+import logging
 import requests
 import json
 import os
 
+logger = logging.getLogger(__name__)
+
 # API Base URL
 API_BASE_URL = os.getenv('DJANGO_API_URL', 'http://localhost:8000/api')
 
@@ -134,6 +138,30 @@ def api_verify_session(session_id):
         return {"success": False, "valid": False, "message": f"Lỗi kết nối API: {str(e)}"}
 
 
+def api_get_sidebar_bundle(session_id, load_chat_session_id=None):
+    """Gọi API bundle: verify session + danh sách files + chat sessions
+    (kèm lịch sử của một chat session nếu cần) trong 1 request"""
+    try:
+        payload = {'session_id': session_id}
+        if load_chat_session_id:
+            payload['load_chat_session_id'] = load_chat_session_id
+        response = requests.post(
+            f'{API_BASE_URL}/sidebar/bundle/',
+            json=payload,
+            headers=get_auth_headers(session_id),
+            timeout=15
+        )
+        if response.status_code == 200:
+            result = response.json()
+            if not isinstance(result, dict):
+                return {"success": False, "valid": False}
+            return result
+        else:
+            return {"success": False, "valid": False}
+    except Exception as e:
+        return {"success": False, "valid": False, "message": f"Lỗi kết nối API: {str(e)}"}
+
+
 def api_chat_send(message, session_id, selected_file=None, chat_session_id=None):
     """Gọi API gửi tin nhắn chat"""
     try:
@@ -155,6 +183,42 @@ def api_chat_send(message, session_id, selected_file=None, chat_session_id=None)
         return {"success": False, "response": f"Lỗi kết nối API: {str(e)}"}
 
 
+def api_chat_send_stream(message, session_id, selected_file=None, chat_session_id=None):
+    """
+    Gọi API chat streaming: generator yield từng object NDJSON từ server
+    ({"delta": ...} cho mỗi mẩu text, {"done": ..., "chat_session_id": ...}
+    khi kết thúc). Lỗi kết nối yield {"error": ...} rồi dừng.
+    """
+    try:
+        with requests.post(
+            f'{API_BASE_URL}/chat/send/stream/',
+            json={
+                'message': message,
+                'session_id': session_id,
+                'selected_file': selected_file,
+                'chat_session_id': chat_session_id
+            },
+            headers=get_auth_headers(session_id),
+            stream=True,
+            # (connect, read): read timeout tính GIỮA các chunk stream nên
+            # generation dài vẫn chạy, chỉ server im bặt mới bị cắt - không
+            # có timeout thì thread pump treo vĩnh viễn khi TCP stall
+            timeout=(10, 90)
+        ) as response:
+            if response.status_code != 200:
+                yield {"error": "Lỗi khi gửi tin nhắn"}
+                return
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except Exception as e:
+        yield {"error": f"Lỗi kết nối API: {str(e)}"}
+
+
 def api_get_chat_sessions(session_id):
     """Gọi API lấy danh sách chat sessions"""
     try:
@@ -210,11 +274,21 @@ def api_upload_files(files, session_id):
         file_handles = []
         
         for file in files:
-            # Lấy path từ SimpleNamespace hoặc file object
-            file_path = getattr(file, 'path', None) or getattr(file, 'name', None)
             # Lấy tên file gốc (nếu có)
             original_name = getattr(file, 'name', None)
-            
+
+            # Wrapper giữ bytes trong RAM: stream thẳng qua BytesIO,
+            # không cần mở file trên đĩa
+            content = getattr(file, 'content', None)
+            if content is not None:
+                stream = io.BytesIO(content)
+                file_handles.append(stream)
+                files_data.append(('files', (original_name or 'upload.pdf', stream, 'application/pdf')))
+                continue
+
+            # Lấy path từ wrapper hoặc file object
+            file_path = getattr(file, 'path', None) or original_name
+
             if not file_path or not os.path.exists(file_path):
                 logger.warning(f"File không tồn tại: {file_path}")
                 continue
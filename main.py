@@ -1,11 +1,14 @@
+import functools
 import json
 import os
+import re
 import tempfile
-from types import SimpleNamespace
+import time
 import asyncio
+import contextvars
 from datetime import datetime
 from uuid import uuid4
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 import logging
 
 import httpx
@@ -16,6 +19,7 @@ logger = logging.getLogger(__name__)
 
 from api_client import (
     api_chat_send,
+    api_chat_send_stream,
     api_clear_all_files,
     api_create_chat_session,
     api_delete_file,
@@ -23,6 +27,7 @@ from api_client import (
     api_get_chat_history,
     api_get_chat_sessions,
     api_get_files,
+    api_get_sidebar_bundle,
     api_login,
     api_logout,
     api_register,
@@ -42,6 +47,19 @@ load_dotenv()
 STORAGE_SECRET = os.getenv("STORAGE_SECRET", "ragviet-dev-secret")
 DJANGO_API_URL = os.getenv("DJANGO_API_URL", "http://localhost:8000/api")
 app.storage.secret = STORAGE_SECRET
+
+# Self-host MathJax nếu bundle đã được tải về static/mathjax/ để bỏ một
+# cross-origin fetch khỏi critical path của mọi page; chưa có thì dùng CDN
+_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+_LOCAL_MATHJAX = os.path.join(_STATIC_DIR, "mathjax", "tex-mml-chtml.js")
+if os.path.isdir(_STATIC_DIR):
+    app.add_static_files("/static", _STATIC_DIR)
+MATHJAX_SRC = (
+    "/static/mathjax/tex-mml-chtml.js"
+    if os.path.exists(_LOCAL_MATHJAX)
+    else "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"
+)
+
 ui.add_head_html("""
 <style>
 .nicegui-content{padding:0!important;}
@@ -119,8 +137,6 @@ blockquote {
   height: 0;
 }
 </style>
-<script src="https://polyfill.io/v3/polyfill.min.js?features=es6"></script>
-<script id="MathJax-script" async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
 <script>
 window.MathJax = {
     tex: {
@@ -129,9 +145,278 @@ window.MathJax = {
     }
 };
 </script>
+<script defer id="MathJax-script" src=\"""" + MATHJAX_SRC + """\"></script>
 """, shared=True)
 
+# Regex và hằng số cho format_text - compile một lần lúc import
+# thay vì compile lại cho từng message được render
+_STRONG_OPEN_RE = re.compile(r'strong>')
+_STRONG_CLOSE_RE = re.compile(r'</strong>')
+_MATH_CHARS = frozenset('∑∫=≤≥≠±×÷αβγδεθλμπσφωΔΩ∞')
+_RE_MATH_UNDER = re.compile(r'[a-z]_[a-z]')
+_RE_CAMEL = re.compile(r'[A-Z][a-z]+[A-Z]')
+# Case-sensitive: IGNORECASE chặn các fast-path literal của engine regex; tag
+# LLM sinh ra đều lowercase, trường hợp lạ được cover bằng .lower() tại chỗ gọi
+_RE_HAS_HTML = re.compile(r'<(strong|em|ul|li|h[1-6]|blockquote|div|p|code)[^>]*>')
+_RE_UL = re.compile(r'(<li[^>]*>.*?</li>(?:\s*<li[^>]*>.*?</li>)*)', re.DOTALL)
+
+
+# Trạng thái cho state machine blockquote/math trong _format_text_impl
+_BQ_PLAIN, _BQ_QUOTE, _BQ_MATH = 0, 1, 2
+
+
+def _has_html_tags(s: str) -> bool:
+    """Probe xem chuỗi đã chứa tag HTML hay chưa (tag tự sinh luôn lowercase)."""
+    if '<' not in s:
+        return False
+    if _RE_HAS_HTML.search(s) is not None:
+        return True
+    # Tag viết hoa hiếm gặp: chỉ khi đó mới tốn một lần lower()
+    return _RE_HAS_HTML.search(s.lower()) is not None
+# Ký tự mở đầu mọi construct markdown mà _RE_MD xử lý: vắng cả 4 ký tự này
+# thì paragraph chắc chắn là prose thuần, khỏi chạy alternation
+_MD_MARKS = frozenset('*`#-')
+
+# Escape HTML bằng một lượt str.translate C-level thay vì html.escape
+# (bên trong là 5 lần str.replace quét lại chuỗi); cùng output với
+# html.escape(s, quote=True)
+_HTML_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;',
+})
+
+
+def _escape(s: str) -> str:
+    return s.translate(_HTML_ESCAPE_TABLE)
+
+# Gộp 7 pattern markdown (heading/li/bold/italic/code) vào một alternation:
+# một pass duy nhất quét text thay vì 7 lần re.sub quét lại từ đầu.
+# Tên group = loại construct, m.lastgroup cho biết nhánh nào khớp.
+_RE_MD = re.compile(
+    r'^###\s+(?P<h3>.+)$'
+    r'|^##\s+(?P<h2>.+)$'
+    r'|^#\s+(?P<h1>.+)$'
+    r'|^-\s+(?P<li>.+)$'
+    r'|\*\*(?P<bold>[^*]+?)\*\*'
+    r'|(?<!\*)\*(?P<ital>[^*]+?)\*(?!\*)'
+    r'|`(?P<code>[^`]+?)`',
+    re.MULTILINE,
+)
+
+_MD_STYLE = {
+    'code': '<code style="background: #f4f4f4; padding: 2px 6px; border-radius: 3px; font-family: monospace;">{}</code>',
+    'li': '<li style="margin: 0.3em 0;">{}</li>',
+    'h3': '<h3 style="font-size: 1.2em; font-weight: bold; margin: 1em 0 0.5em 0; color: #333;">{}</h3>',
+    'h2': '<h2 style="font-size: 1.4em; font-weight: bold; margin: 1.2em 0 0.6em 0; color: #222;">{}</h2>',
+    'h1': '<h1 style="font-size: 1.6em; font-weight: bold; margin: 1.5em 0 0.8em 0; color: #111;">{}</h1>',
+}
+
+
+# Code span xử lý riêng cho nội dung bold/italic: mô phỏng thứ tự pass cũ
+# (code chạy sau bold/italic trên cả chuỗi) mà không recurse cả alternation -
+# các nhánh ^heading/li không được phép khớp giữa dòng
+_RE_CODE_SPAN = re.compile(r'`([^`]+?)`')
+
+
+def _code_span_sub(match):
+    return _MD_STYLE['code'].format(match.group(1))
+
+
+def _md_dispatch(match):
+    kind = match.lastgroup
+    content = match.group(kind)
+    if kind == 'bold':
+        if '<strong>' in content or '</strong>' in content:
+            return match.group(0)
+        inner = _RE_CODE_SPAN.sub(_code_span_sub, _escape(content))
+        return f'<strong>{inner}</strong>'
+    if kind == 'ital':
+        inner = _RE_CODE_SPAN.sub(_code_span_sub, content)
+        return f'<em>{inner}</em>'
+    if kind == 'code':
+        return _MD_STYLE['code'].format(content)
+    # h1/h2/h3/li: format inline markdown bên trong dòng trước rồi mới bọc tag
+    return _MD_STYLE[kind].format(_RE_MD.sub(_md_dispatch, content))
+
+
+def _format_text_impl(text: str) -> str:
+    """Format text với markdown và MathJax support"""
+    text = _STRONG_OPEN_RE.sub('<strong>', text)
+    text = _STRONG_CLOSE_RE.sub('</strong>', text)
+
+    lines = text.split('\n')
+
+    # Không có '>' thì không thể có blockquote/math: một lượt memchr C-level
+    # thay cho cả state machine per-line - đáng kể khi bulk-render history
+    if '>' not in text:
+        formatted_lines = lines
+        return _format_paragraphs(formatted_lines)
+
+    formatted_lines = []
+    # State machine 3 trạng thái: đang fill buffer nào (plain/quote/math);
+    # tag <blockquote> mở/đóng theo dõi riêng vì nó sống xuyên qua _BQ_MATH
+    state = _BQ_PLAIN
+    bq_open = False
+    math_lines = []
+    # Buffer các dòng blockquote thường liên tiếp: escape + emit một <p>
+    # cho cả run thay vì một lần html.escape + f-string cho từng dòng
+    bq_buf = []
+
+    def _flush_math():
+        formatted_lines.append(
+            '<div class="math-formula">' + _escape('\n'.join(math_lines)) + '</div>'
+        )
+        math_lines.clear()
+
+    def _flush_bq():
+        formatted_lines.append(
+            '<p>' + _escape('\n'.join(bq_buf)).replace('\n', '<br>') + '</p>'
+        )
+        bq_buf.clear()
+
+    # lstrip là đủ cho check startswith('>'), đỡ một lần cấp phát so với strip;
+    # strip sẵn cả mảng một lượt để check "dòng trước là quote" khỏi strip lại
+    stripped_lines = [ln.lstrip() for ln in lines]
+
+    for i, stripped in enumerate(stripped_lines):
+        if stripped.startswith('>'):
+            # Check math ngay trên dòng gốc (prefix '>' không nằm trong
+            # _MATH_CHARS và không ảnh hưởng hai pattern chữ cái), khỏi phải
+            # cắt chuỗi trước khi biết nhánh nào cần nội dung
+            # isdisjoint chạy ở C-level thay vì generator Python từng ký tự
+            is_math = not _MATH_CHARS.isdisjoint(stripped) or \
+                     _RE_MATH_UNDER.search(stripped) or \
+                     _RE_CAMEL.search(stripped) or \
+                     (state == _BQ_MATH and i > 0 and stripped_lines[i-1].startswith('>'))
+
+            # '> nội dung' là dạng phổ biến nhất: slice đúng một lần từ sau
+            # dấu cách; chỉ rơi về strip() khi còn whitespace thừa hai đầu
+            content = stripped[2:] if stripped.startswith('> ') else stripped[1:]
+            if content[:1] in (' ', '\t') or content[-1:] in (' ', '\t'):
+                content = content.strip()
+
+            if is_math:
+                if state == _BQ_QUOTE:
+                    _flush_bq()
+                state = _BQ_MATH
+                math_lines.append(content)
+            else:
+                if state == _BQ_MATH:
+                    _flush_math()
+                if not bq_open:
+                    formatted_lines.append('<blockquote>')
+                    bq_open = True
+                state = _BQ_QUOTE
+                bq_buf.append(content)
+        else:
+            # Transition về PLAIN: flush đúng buffer đang mở rồi đóng tag
+            if state == _BQ_MATH:
+                _flush_math()
+            elif state == _BQ_QUOTE:
+                _flush_bq()
+            if bq_open:
+                formatted_lines.append('</blockquote>')
+                bq_open = False
+            state = _BQ_PLAIN
+            formatted_lines.append(lines[i])
+
+    if state == _BQ_MATH:
+        _flush_math()
+    elif state == _BQ_QUOTE:
+        _flush_bq()
+    if bq_open:
+        formatted_lines.append('</blockquote>')
+
+    return _format_paragraphs(formatted_lines)
+
+
+def _format_paragraphs(formatted_lines: List[str]) -> str:
+    """Gom các dòng đã xử lý thành paragraph rồi áp markdown + escape."""
+    # Gom paragraph trực tiếp trong một lượt duyệt formatted_lines trên blank
+    # line, thay vì join cả text rồi để regex \n\s*\n quét lại từ đầu
+    paragraphs = []
+    cur = []
+    for ln in formatted_lines:
+        if ln.strip():
+            cur.append(ln)
+        elif cur:
+            paragraphs.append('\n'.join(cur))
+            cur = []
+    if cur:
+        paragraphs.append('\n'.join(cur))
+
+    # Check '<' trước (memchr C-level) để khỏi chạy regex trên text thuần
+    has_html_tags = any(_has_html_tags(p) for p in paragraphs)
+
+    formatted_paragraphs = []
+    for para in paragraphs:
+        para = para.strip()
+        if not para:
+            continue
+
+        if not has_html_tags and not _MD_MARKS.isdisjoint(para):
+            # Một pass alternation + dispatch thay cho 7 lần sub quét lại text;
+            # chỉ bước gom <li> liên tiếp thành <ul> cần pass DOTALL riêng
+            para = _RE_MD.sub(_md_dispatch, para)
+            if '<li' in para:
+                para = _RE_UL.sub(r'<ul style="margin: 0.5em 0; padding-left: 1.5em;">\1</ul>', para)
+
+        para_has_html = _has_html_tags(para)
+
+        if para_has_html:
+            formatted_paragraphs.append(para)
+        elif para.startswith('<') and (para.startswith('<h') or para.startswith('<ul') or para.startswith('<blockquote') or para.startswith('<div')):
+            formatted_paragraphs.append(para)
+        else:
+            para_escaped = _escape(para)
+            para_escaped = para_escaped.replace('\n', '<br>')
+            formatted_paragraphs.append(f'<p style="margin: 0.5em 0; line-height: 1.6;">{para_escaped}</p>')
+
+    formatted = '\n'.join(formatted_paragraphs)
+    # Collapse <br> lặp bằng str.replace literal (two-way search C-level)
+    # thay vì NFA regex; chuẩn hóa biến thể có whitespace xen giữa trước
+    formatted = formatted.replace('<br>\n<br>', '<br><br>').replace('<br> <br>', '<br><br>')
+    while '<br><br>' in formatted:
+        formatted = formatted.replace('<br><br>', '<br>')
+
+    return formatted
+
+
+@functools.lru_cache(maxsize=512)
+def _format_text_cached(text: str) -> str:
+    return _format_text_impl(text)
+
+
+def format_text(text: str) -> str:
+    """Format text, memoize theo nội dung: cùng một message được render lại
+    (load history, refresh view) không phải chạy lại cả pipeline regex.
+    Response quá lớn thì bỏ qua cache để không chiếm chỗ của các entry nhỏ."""
+    if len(text) > 20_000:
+        return _format_text_impl(text)
+    return _format_text_cached(text)
+
+
 class SessionState:
+    # __slots__ bỏ __dict__ của instance: truy cập attribute nhanh hơn và gọn bộ nhớ hơn.
+    # _is_logged_in là flag thường (cập nhật tại login/restore/logout) thay cho @property
+    # để mỗi lần đọc không phải qua descriptor.
+    __slots__ = (
+        "session_id",
+        "access_token",
+        "user",
+        "selected_file",
+        "chat_session_id",
+        "pending_load_history",
+        "file_chunks",
+        "_is_logged_in",
+        "refresh_sidebar_history",
+        "refresh_delete_file_list",
+        "load_chat_history",
+    )
+
     def __init__(self):
         self.session_id: Optional[str] = None
         self.access_token: Optional[str] = None
@@ -141,10 +426,11 @@ class SessionState:
         self.pending_load_history: Optional[str] = None  # Chat session ID cần load
         # Lưu thông tin số chunks cho mỗi file để kiểm tra tài liệu chưa được chunk
         self.file_chunks: dict = {}
-
-    @property
-    def is_logged_in(self) -> bool:
-        return bool(self.session_id)
+        self._is_logged_in: bool = False
+        # Các callback được gán từ sidebar/trang chủ sau khi render
+        self.refresh_sidebar_history = None
+        self.refresh_delete_file_list = None
+        self.load_chat_history = None
 
 
 session_state = SessionState()
@@ -155,25 +441,54 @@ def _get_user_store():
     Lấy storage gắn với client (server-side, không phụ thuộc browser dict).
     Dùng user-level storage để tránh lỗi "response has been built".
     """
+    # Thử lấy từ context.client trước - chỉ dòng này có thể raise
+    # (RuntimeError khi gọi ngoài ngữ cảnh client, vd background task)
     try:
-        # Thử lấy từ context.client trước
-        if hasattr(context, "client") and context.client:
-            client_store = getattr(context.client, "storage", None)
-            if client_store:
-                user = getattr(client_store, "user", None)
-                if user is not None:
-                    return user
-        # Fallback về app.storage.user
-        app_store = getattr(app, "storage", None)
-        if app_store:
-            user = getattr(app_store, "user", None)
+        client = getattr(context, "client", None)
+    except RuntimeError:
+        client = None
+    if client:
+        # Cache store đã resolve trên client (scope theo connection) để các
+        # lần gọi tiếp theo trong cùng request không phải walk attribute lại
+        cached = getattr(client, "_ragviet_user_store", None)
+        if cached is not None:
+            return cached
+        client_store = getattr(client, "storage", None)
+        if client_store:
+            user = getattr(client_store, "user", None)
             if user is not None:
+                try:
+                    client._ragviet_user_store = user
+                except AttributeError:
+                    pass
                 return user
-    except Exception:
+    # Fallback về app.storage.user - cũng raise RuntimeError khi chưa có connection
+    try:
+        app_store = getattr(app, "storage", None)
+        if app_store:
+            return getattr(app_store, "user", None)
+    except RuntimeError:
         pass
     return None
 
 
+# Memoize verify session theo bucket thời gian 60 giây: trong cùng một bucket
+# (navbar, require_auth, sidebar... của cùng lượt điều hướng) chỉ tốn một
+# roundtrip verify; sang bucket mới cache tự miss nên độ cũ tối đa là 60s.
+# Logout/clear storage evict chủ động nên session hết hiệu lực không bị giữ lại.
+_VERIFY_BUCKET_SECONDS = 60
+
+
+@functools.lru_cache(maxsize=4096)
+def _verify_session_cached(session_id: str, bucket: int) -> dict:
+    return api_verify_session(session_id)
+
+
+def _evict_verify_cache(session_id: Optional[str] = None):
+    """Xóa cache verify - gọi sau logout hoặc khi session không còn hợp lệ."""
+    _verify_session_cached.cache_clear()
+
+
 def save_session_to_storage():
     """Lưu session vào storage server-side (user storage) để reload không mất."""
     user_store = _get_user_store()
@@ -188,26 +503,41 @@ def clear_session_storage():
     user_store = _get_user_store()
     if not user_store:
         return
+    _evict_verify_cache(user_store.get("session_id"))
     for key in ("session_id", "access_token", "user"):
         user_store.pop(key, None)
 
+# Guard per-task: require_auth rồi render_navbar cùng một lượt build trang đều
+# gọi restore - lần thất bại đầu tiên là đủ, khỏi traverse storage lại
+_session_restore_attempted: contextvars.ContextVar = contextvars.ContextVar(
+    "ragviet_session_restored", default=False
+)
+
+
 def restore_session_from_storage():
     """Khôi phục session từ local storage nếu còn hợp lệ."""
-    if session_state.is_logged_in:
+    if session_state._is_logged_in:
         return True
-    
+    if _session_restore_attempted.get():
+        return False
+    _session_restore_attempted.set(True)
+
     user_store = _get_user_store()
     if not user_store:
         return False
     stored_session = user_store.get("session_id")
     if not stored_session:
         return False
-    verify = api_verify_session(stored_session)
+    verify = _verify_session_cached(stored_session, int(time.time() // _VERIFY_BUCKET_SECONDS))
+    if not (verify.get("success") and verify.get("valid")):
+        # Không giữ lại kết quả fail trong cache
+        _evict_verify_cache(stored_session)
     if verify.get("success") and verify.get("valid"):
         session_state.session_id = stored_session
         session_state.access_token = stored_session
         session_state.user = verify.get("user")
         session_state.chat_session_id = verify.get("chat_session_id")
+        session_state._is_logged_in = True
         print(f"DEBUG: Restored session. chat_session_id={session_state.chat_session_id}")
         return True
     clear_session_storage()
@@ -298,24 +628,85 @@ def notify_error(msg: str):
 
 
 def require_login() -> bool:
-    if not session_state.is_logged_in:
+    if not session_state._is_logged_in:
         notify_error("Vui lòng đăng nhập để sử dụng tính năng này")
         return False
     return True
 
 def require_auth():
     """Kiểm tra đăng nhập và redirect về /login nếu chưa đăng nhập."""
-    if not session_state.is_logged_in:
+    if not session_state._is_logged_in:
+        _redirect_to_login()
+        return False
+    return True
+
+
+def _redirect_to_login():
+    """Redirect về /login qua navigate (không cần render xong cả trang)."""
+    try:
+        ui.navigate.to("/login")
+    except RuntimeError:
+        # Chưa gắn client context: rơi về inject script như cũ
         ui.add_head_html(
-            '<script>window.location.href = "/login";</script>',
+            '<script>location.replace("/login");</script>',
             shared=False
         )
-        ui.label("Đang chuyển đến trang đăng nhập...").classes("text-center p-4")
-        return False
-    return True
 
-def refresh_files_list() -> Tuple[str, List[str]]:
-    result = api_get_files(session_state.session_id)
+# Coalesce các API call giống nhau đang in-flight: mọi caller cùng await một task,
+# chỉ một roundtrip thực sự được thực hiện (tránh retry/refresh gọi trùng lặp)
+_inflight: dict = {}  # (tên hàm, session_id) -> asyncio.Task
+
+
+async def _coalesced_call(fn, session_id):
+    """Gọi fn(session_id) trong thread pool; các lời gọi trùng nhau chia sẻ kết quả."""
+    key = (fn.__name__, session_id)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(fn, session_id))
+        _inflight[key] = task
+        task.add_done_callback(lambda t, k=key: _inflight.pop(k, None))
+    # shield để một caller bị cancel không hủy task chung của các caller khác
+    return await asyncio.shield(task)
+
+
+def _session_options(sessions: List[dict]) -> dict:
+    """Build options {session_id: display_text} cho dropdown lịch sử chat."""
+    options = {}
+    for session in sessions:
+        s_id = session.get("session_id")
+        if not s_id:
+            continue
+        title = session.get("title", "Chat không có tiêu đề")
+        time_str = session.get("updated_at") or session.get("created_at", "")
+
+        display_text = f"{title[:30]}..." if len(title) > 30 else title
+        if time_str:
+            display_text += f" ({time_str})"
+        options[s_id] = display_text
+    return options
+
+
+def _all_options(file_names: List[str]) -> List[str]:
+    """Ghép option "Tất cả" với danh sách file cho dropdown chọn tài liệu."""
+    return ["Tất cả"] + list(file_names)
+
+
+# Cache display text + danh sách file theo session với TTL ngắn: display text là
+# pure function của danh sách file nên không cần gọi API + ghép chuỗi lại mỗi render
+_FILES_DISPLAY_TTL = 5  # giây
+_files_display_cache: dict = {}  # session_id -> (display_text, file_names, hết hạn lúc)
+
+
+def _invalidate_files_cache(session_id: Optional[str] = None):
+    """Xóa cache danh sách file - gọi sau khi upload/xóa file."""
+    if session_id is None:
+        _files_display_cache.clear()
+    else:
+        _files_display_cache.pop(session_id, None)
+
+
+def _build_files_display(result: dict) -> Tuple[str, List[str]]:
+    """Build display text + danh sách tên file từ response của api_get_files."""
     if not result.get("success") or result.get("total_files", 0) == 0:
         return "Chưa có file nào được upload.", []
     files = result.get("files", [])
@@ -337,212 +728,298 @@ def refresh_files_list() -> Tuple[str, List[str]]:
     file_names = [file["filename"] for file in files]
     return display_text, file_names
 
+
+def refresh_files_list() -> Tuple[str, List[str]]:
+    cached = _files_display_cache.get(session_state.session_id)
+    if cached and cached[2] > time.monotonic():
+        return cached[0], cached[1]
+    result = api_get_files(session_state.session_id)
+    display_text, file_names = _build_files_display(result)
+    if result.get("success"):
+        _files_display_cache[session_state.session_id] = (
+            display_text, file_names, time.monotonic() + _FILES_DISPLAY_TTL
+        )
+    return display_text, file_names
+
 async def async_refresh_files_list() -> Tuple[str, List[str]]:
     """Async version của refresh_files_list để không block UI"""
-    result = await asyncio.to_thread(api_get_files, session_state.session_id)
-    if not result.get("success") or result.get("total_files", 0) == 0:
-        return "Chưa có file nào được upload.", []
-    files = result.get("files", [])
-    try:
-        session_state.file_chunks = {
-            file["filename"]: file.get("chunks", 0) for file in files
-        }
-    except Exception:
-        session_state.file_chunks = {}
-    files_list = "\n".join(
-        [f"📄 {file['filename']}: {file['chunks']} chunks" for file in files]
-    )
-    display_text = (
-        f"- Tổng số tài liệu: {result['total_files']}\n"
-        f"- Tổng số chunks: {result['total_chunks']}\n"
-        f"{files_list}"
-    )
-    file_names = [file["filename"] for file in files]
+    cached = _files_display_cache.get(session_state.session_id)
+    if cached and cached[2] > time.monotonic():
+        return cached[0], cached[1]
+    result = await _coalesced_call(api_get_files, session_state.session_id)
+    display_text, file_names = _build_files_display(result)
+    if result.get("success"):
+        _files_display_cache[session_state.session_id] = (
+            display_text, file_names, time.monotonic() + _FILES_DISPLAY_TTL
+        )
     return display_text, file_names
 
 
-async def upload_temp_files(upload_event) -> bool:
-    """Nhận UploadEvent (có thể 1 hoặc nhiều file) và gọi API upload."""
+# Số file upload được chuẩn bị (đọc + ghi temp) đồng thời - 8 là mức đủ
+# bão hòa băng thông đĩa mà không giữ quá nhiều blob bytes trong RAM cùng lúc
+PROCESSOR_CONCURRENCY = 8
+
+# Các attr có thể chứa tên / đường dẫn file tùy loại upload event,
+# quét một lượt bằng getattr thay vì cascade hasattr
+_NAME_ATTRS = ("name", "filename")
+_PATH_ATTRS = ("path", "file_path", "tmp_path")
+
+# Ngưỡng dung lượng cộng dồn cho một request upload multipart
+_UPLOAD_BATCH_BYTES = 20 * 1024 * 1024
+
+
+class _TempFile:
+    """Wrapper nhẹ cho file chờ upload - __slots__ đỡ tốn __dict__ như SimpleNamespace.
+
+    Hoặc trỏ tới file trên đĩa (path), hoặc giữ thẳng bytes trong RAM (content)
+    để api_upload_files stream qua BytesIO không cần ghi/đọc đĩa.
+    """
+
+    __slots__ = ("path", "name", "_external", "content")
+
+    def __init__(self, path: Optional[str], name: str, _external: bool = False,
+                 content: Optional[bytes] = None):
+        self.path = path
+        self.name = name
+        # File thuộc về NiceGUI (không phải mình tạo) thì cleanup không được xóa
+        self._external = _external
+        self.content = content
+
+
+def _chunk_by_size(wrappers, max_bytes: int = _UPLOAD_BATCH_BYTES):
+    """Chia wrappers thành các batch có tổng size ≤ max_bytes, mỗi batch một POST."""
+    batch, batch_bytes = [], 0
+    for w in wrappers:
+        if getattr(w, "content", None) is not None:
+            size = len(w.content)
+        else:
+            try:
+                size = os.path.getsize(w.path)
+            except OSError:
+                size = 0
+        if batch and batch_bytes + size > max_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(w)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _safe_unlink(path: str):
+    """Xóa một file tạm (blocking) - bỏ qua nếu đã biến mất."""
+    try:
+        # unlink thẳng thay vì exists + remove: 1 syscall thay vì 2
+        os.unlink(path)
+        logger.debug("Deleted temp file: %s", path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Không thể xóa temp file {path}: {e}")
+
+
+def _read_bytes(path: str) -> bytes:
+    """Đọc toàn bộ file (blocking) - gọi qua asyncio.to_thread để không chặn event loop."""
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+def _write_temp_content(content, suffix: str, prefix: str = "ragviet_") -> str:
+    """Ghi nội dung (bytes / file-like / str) ra temp file mới, trả về path (blocking).
+
+    Dùng mkstemp + os.write trên raw fd: một syscall cho cả khối bytes thay vì
+    BufferedWriter copy từng chunk 8KB, và không cần cặp flush()/close() thừa.
+    """
+    if isinstance(content, bytes):
+        data = content
+    elif hasattr(content, "read"):
+        data = content.read()
+    else:
+        data = str(content).encode()
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, prefix=prefix)
+    try:
+        os.write(fd, data)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+    return tmp_path
+
+
+async def upload_temp_files(upload_event) -> Union[Dict, bool]:
+    """Nhận UploadEvent (có thể 1 hoặc nhiều file) và gọi API upload.
+
+    Returns:
+        Dict response của API khi upload thành công (kèm danh sách file
+        mới và cờ indexed để caller render thẳng), False khi thất bại.
+    """
     if not require_login():
         return False    
 
     incoming = []
-    
-    logger.info(f"=== UPLOAD EVENT DEBUG ===")
-    logger.info(f"Type: {type(upload_event)}")
-    if hasattr(upload_event, "__dict__"):
-        logger.info(f"Dict: {upload_event.__dict__}")
-    if hasattr(upload_event, "__class__"):
-        logger.info(f"Class: {upload_event.__class__}")
-        logger.info(f"Class attributes: {[x for x in dir(upload_event.__class__) if not x.startswith('_')]}")
-    logger.info(f"All attributes: {[x for x in dir(upload_event) if not x.startswith('_')]}")
-    
-    # Thử nhiều cách để lấy files
-    if hasattr(upload_event, "files") and upload_event.files:
-        incoming = upload_event.files if isinstance(upload_event.files, list) else [upload_event.files]
-        logger.info(f"Got files from .files attribute: {len(incoming)} files")
-    elif hasattr(upload_event, "file") and upload_event.file:
-        incoming = [upload_event.file] if not isinstance(upload_event.file, list) else upload_event.file
-        logger.info(f"Got files from .file attribute: {len(incoming)} files")
+
+    # Introspection (dir()/__dict__) chỉ chạy khi DEBUG được bật - ở INFO các
+    # biểu thức này vẫn bị evaluate dù log bị bỏ, rất tốn cho batch nhiều file
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("=== UPLOAD EVENT DEBUG ===")
+        logger.debug("Type: %s", type(upload_event))
+        if hasattr(upload_event, "__dict__"):
+            logger.debug("Dict: %s", upload_event.__dict__)
+        if hasattr(upload_event, "__class__"):
+            logger.debug("Class: %s", upload_event.__class__)
+            logger.debug("Class attributes: %s", [x for x in dir(upload_event.__class__) if not x.startswith('_')])
+        logger.debug("All attributes: %s", [x for x in dir(upload_event) if not x.startswith('_')])
+
+    # Thử nhiều cách để lấy files - một getattr cho mỗi nguồn
+    files_attr = getattr(upload_event, "files", None)
+    file_attr = getattr(upload_event, "file", None)
+    if files_attr:
+        incoming = files_attr if isinstance(files_attr, list) else [files_attr]
+        logger.debug("Got files from .files attribute: %s files", len(incoming))
+    elif file_attr:
+        incoming = file_attr if isinstance(file_attr, list) else [file_attr]
+        logger.debug("Got files from .file attribute: %s files", len(incoming))
     elif isinstance(upload_event, list):
         incoming = upload_event
-        logger.info(f"Upload event is a list: {len(incoming)} items")
+        logger.debug("Upload event is a list: %s items", len(incoming))
     elif hasattr(upload_event, "__iter__") and not isinstance(upload_event, str):
         try:
             incoming = list(upload_event)
-            logger.info(f"Upload event is iterable: {len(incoming)} items")
+            logger.debug("Upload event is iterable: %s items", len(incoming))
         except:
             incoming = [upload_event]
-            logger.info(f"Could not iterate, treating as single item")
+            logger.debug("Could not iterate, treating as single item")
     else:
         incoming = [upload_event]
-        logger.info(f"Treating upload event as single item")
+        logger.debug("Treating upload event as single item")
 
     logger.info(f"Received upload event with {len(incoming)} file(s)")
-    logger.info(f"Upload event type: {type(upload_event)}")
-    logger.info(f"Upload event attributes: {dir(upload_event) if hasattr(upload_event, '__dict__') else 'N/A'}")
 
-    temp_wrappers: List[SimpleNamespace] = []
-    try:
-        for idx, f in enumerate(incoming):
-            logger.info(f"Processing file {idx+1}/{len(incoming)}")
-            logger.info(f"File object type: {type(f)}")
-            logger.info(f"File object attributes: {dir(f) if hasattr(f, '__dict__') else 'N/A'}")
-            
-            # Lấy tên file gốc - thử nhiều cách
-            original_name = None
-            if hasattr(f, "name"):
-                original_name = f.name
-                logger.info(f"Got name from .name: {original_name}")
-            elif hasattr(f, "filename"):
-                original_name = f.filename
-                logger.info(f"Got name from .filename: {original_name}")
-            elif isinstance(f, dict):
+    # Semaphore giới hạn số file chuẩn bị đồng thời để disk/thread pool không bị thrash
+    sem = asyncio.Semaphore(PROCESSOR_CONCURRENCY)
+
+    async def _prepare_file(idx: int, f) -> Optional[_TempFile]:
+        """Đọc một file upload và ghi ra temp file. Trả về wrapper hoặc None nếu lỗi."""
+        async with sem:
+            logger.debug("Processing file %s/%s", idx + 1, len(incoming))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("File object type: %s", type(f))
+                logger.debug("File object attributes: %s", dir(f) if hasattr(f, '__dict__') else 'N/A')
+
+            # Lấy tên file gốc - quét bảng attr một lượt
+            if isinstance(f, dict):
                 original_name = f.get("name") or f.get("filename")
-                logger.info(f"Got name from dict: {original_name}")
-            elif hasattr(f, "__dict__"):
-                # Thử lấy từ __dict__
-                original_name = getattr(f, "__dict__", {}).get("name") or getattr(f, "__dict__", {}).get("filename")
-                logger.info(f"Got name from __dict__: {original_name}")
-            
+            else:
+                original_name = next(
+                    (getattr(f, a, None) for a in _NAME_ATTRS if getattr(f, a, None)), None
+                )
+
             if not original_name:
                 original_name = "upload.pdf"
                 logger.warning(f"Using default name: {original_name}")
+
+            logger.debug("Final file name: %s", original_name)
             
-            logger.info(f"Final file name: {original_name}")
-            
-            # Lấy nội dung file - thử nhiều cách
+            # Lấy nội dung file: mỗi nguồn một getattr duy nhất thay vì
+            # cascade hasattr + truy cập attr lần hai
             content = None
             file_path = None
-            
+
             # Cách 1: Kiểm tra xem có phải là file path string không
             if isinstance(f, str) and os.path.exists(f):
                 file_path = f
-                logger.info(f"File is a path string: {file_path}")
-            
-            # Cách 2: Đọc từ content attribute
-            elif hasattr(f, "content"):
-                try:
-                    content = f.content
-                    if content:
-                        logger.info(f"Read content from .content attribute: {len(content) if isinstance(content, bytes) else 'not bytes'} bytes")
-                    else:
-                        logger.warning("Content attribute exists but is None/empty")
-                except Exception as e:
-                    logger.warning(f"Error reading .content: {e}")
-            
-            # Cách 3: Đọc từ file object (có thể là coroutine)
-            elif hasattr(f, "read"):
-                try:
-                    if hasattr(f, "seek"):
-                        f.seek(0)
-                    # Kiểm tra xem read() có phải là coroutine không
-                    read_result = f.read()
-                    if asyncio.iscoroutine(read_result):
-                        content = await read_result
-                        logger.info(f"Read content from async .read(): {len(content) if content else 0} bytes")
-                    else:
-                        content = read_result
-                        logger.info(f"Read content from sync .read(): {len(content) if content else 0} bytes")
-                    if hasattr(f, "seek"):
-                        f.seek(0)  # Reset để có thể đọc lại
-                except Exception as e:
-                    logger.warning(f"Could not read from file object: {e}")
-            
-            # Cách 4: Đọc từ path attribute
-            if content is None and file_path is None:
-                if hasattr(f, "path"):
-                    file_path = f.path
-                    logger.info(f"Got path from .path: {file_path}")
-                elif isinstance(f, dict):
-                    file_path = f.get("path")
-                    logger.info(f"Got path from dict: {file_path}")
-                elif hasattr(f, "__dict__"):
-                    file_path = getattr(f, "__dict__", {}).get("path")
-                    logger.info(f"Got path from __dict__: {file_path}")
-            
-            # Đọc từ file path nếu có
-            if file_path and os.path.exists(file_path):
-                try:
-                    with open(file_path, 'rb') as file_handle:
-                        content = file_handle.read()
-                    logger.info(f"Read content from path {file_path}: {len(content)} bytes")
-                except Exception as e:
-                    logger.error(f"Could not read from path {file_path}: {e}")
-            
-            # Cách 5: NiceGUI có thể lưu file trong thư mục tạm
-            if content is None:
-                # Thử tìm trong thư mục upload của NiceGUI
-                possible_paths = [
-                    getattr(f, "path", None),
-                    getattr(f, "file_path", None),
-                    getattr(f, "tmp_path", None),
-                ]
-                for pp in possible_paths:
-                    if pp and os.path.exists(pp):
+                logger.debug("File is a path string: %s", file_path)
+            else:
+                # Cách 2: content attribute có sẵn
+                content = getattr(f, "content", None)
+                if content is not None:
+                    logger.debug("Read content from .content attribute: %s bytes",
+                                 len(content) if isinstance(content, bytes) else 'not bytes')
+                else:
+                    # Cách 3: file object có .read() (có thể là coroutine)
+                    read = getattr(f, "read", None)
+                    if read is not None:
+                        seek = getattr(f, "seek", None)
                         try:
-                            with open(pp, 'rb') as file_handle:
-                                content = file_handle.read()
-                            logger.info(f"Read content from possible path {pp}: {len(content)} bytes")
-                            break
-                        except:
-                            pass
-            
+                            if seek is not None:
+                                seek(0)
+                            read_result = read()
+                            if asyncio.iscoroutine(read_result):
+                                content = await read_result
+                                logger.debug("Read content from async .read(): %s bytes", len(content) if content else 0)
+                            else:
+                                content = read_result
+                                logger.debug("Read content from sync .read(): %s bytes", len(content) if content else 0)
+                            if seek is not None:
+                                seek(0)  # Reset để có thể đọc lại
+                        except Exception as e:
+                            logger.warning(f"Could not read from file object: {e}")
+
+            # Cách 4: tìm file đã nằm sẵn trên đĩa - quét bảng path attr một
+            # lượt (gộp cả bước dò thư mục tạm của NiceGUI, cùng các attr này)
+            # để không đọc cả file vào RAM nếu không cần
+            src_path = None
+            if content is None:
+                candidates = [file_path]
+                if isinstance(f, dict):
+                    candidates.append(f.get("path"))
+                else:
+                    candidates.extend(getattr(f, a, None) for a in _PATH_ATTRS)
+                for pp in candidates:
+                    if pp and os.path.exists(pp) and os.path.getsize(pp) > 0:
+                        src_path = pp
+                        logger.debug("Will use file directly from path: %s", pp)
+                        break
+
+            # Zero-copy: file đã nằm sẵn trên đĩa (temp của NiceGUI) thì dùng thẳng
+            # path đó cho uploader - không cần temp file thứ hai, không copy byte nào.
+            # Đánh dấu _external để bước cleanup không xóa file không thuộc về mình.
+            if src_path is not None:
+                logger.debug("Reusing on-disk path for %s: %s", original_name, src_path)
+                return _TempFile(src_path, original_name, _external=True)
+
             if content is None or (isinstance(content, bytes) and len(content) == 0):
                 logger.error(f"Không thể đọc nội dung file: {original_name}")
                 logger.error(f"File object: {f}")
                 logger.error(f"File path: {file_path}")
-                continue
+                return None
             
-            # Tạo file tạm với tên gốc
+            # content đã là bytes trong RAM: gửi thẳng qua multipart bằng
+            # BytesIO - khỏi ghi xuống đĩa rồi mở đọc lại (2 lượt I/O mỗi file)
+            if isinstance(content, bytes):
+                # Sniff magic %PDF bù đuôi .pdf cho tên bị thiếu đuôi
+                if content[:4] == b'%PDF' and not os.path.splitext(original_name)[-1]:
+                    original_name += ".pdf"
+                return _TempFile(None, original_name, content=content)
+
+            # Fallback hiếm (content dạng str/file-like): vẫn đi đường temp file
             file_ext = os.path.splitext(original_name)[-1] or ".pdf"
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=file_ext, prefix="ragviet_")
             try:
-                if isinstance(content, bytes):
-                    tmp.write(content)
-                elif hasattr(content, "read"):
-                    tmp.write(content.read())
-                else:
-                    tmp.write(str(content).encode())
-                tmp.flush()
-                tmp.close()
-                
-                logger.info(f"Created temp file: {tmp.name} for {original_name}")
-                
-                # Lưu cả path và tên gốc
-                temp_wrappers.append(SimpleNamespace(
-                    path=tmp.name, 
-                    name=original_name  # Lưu tên gốc để API biết tên file
-                ))
+                # Ghi file trong thread pool để PDF lớn không chặn event loop
+                tmp_path = await asyncio.to_thread(_write_temp_content, content, file_ext)
+
+                logger.debug("Created temp file: %s for %s", tmp_path, original_name)
+
+                # Lưu cả path và tên gốc để API biết tên file
+                return _TempFile(tmp_path, original_name)
             except Exception as e:
                 logger.error(f"Error writing temp file: {e}")
-                try:
-                    tmp.close()
-                    if os.path.exists(tmp.name):
-                        os.remove(tmp.name)
-                except:
-                    pass
-                continue
+                return None
+
+    temp_wrappers: List[_TempFile] = []
+    try:
+        # Chuẩn bị các file song song thay vì tuần tự từng file một;
+        # return_exceptions để một file hỏng không kéo sập cả batch
+        prepared = await asyncio.gather(
+            *[_prepare_file(i, f) for i, f in enumerate(incoming)],
+            return_exceptions=True,
+        )
+        for w in prepared:
+            if isinstance(w, BaseException):
+                logger.error(f"Error preparing upload file: {w}")
+            elif w is not None:
+                temp_wrappers.append(w)
 
         if not temp_wrappers:
             logger.error("No valid files to upload")
@@ -550,19 +1027,46 @@ async def upload_temp_files(upload_event) -> bool:
             return False
 
         logger.info(f"Uploading {len(temp_wrappers)} file(s) to API...")
-        result = api_upload_files(temp_wrappers, session_state.session_id)
-        
+        # POST multi-MB PDF là blocking I/O - chạy trong thread pool; chia batch
+        # theo tổng dung lượng để nhiều file nhỏ đi chung một request multipart
+        # (đỡ N lần TLS/handshake) mà request nào cũng không phình quá ngưỡng
+        result = None
+        batches_ok = 0
+        for batch in _chunk_by_size(temp_wrappers):
+            batch_result = await asyncio.to_thread(api_upload_files, batch, session_state.session_id)
+            if not batch_result.get("success"):
+                result = batch_result
+                break
+            batches_ok += 1
+            # Batch sau mang snapshot danh sách file mới nhất; giữ warning cũ
+            if result is not None and result.get("warning") and not batch_result.get("warning"):
+                batch_result["warning"] = result["warning"]
+            result = batch_result
+        if result is None:
+            result = {"success": False, "message": "Không tìm thấy file để upload"}
+
+
         if result.get("success"):
+            _invalidate_files_cache(session_state.session_id)
             message = result.get("message", "Đã upload file thành công!")
             # Nếu có warning (file không có text nhưng vẫn upload được)
             if result.get("warning"):
                 notify_success(message, notify_type="warning")
             else:
                 notify_success(message)
-            logger.info("Upload successful, returning True for refresh")
-            return True
+            logger.info("Upload successful, returning result for refresh")
+            # Trả về cả response (có kèm danh sách file mới) để caller
+            # cập nhật UI trực tiếp, không cần poll lại API
+            return result
         else:
             error_msg = result.get("message", "Lỗi khi upload file")
+            if batches_ok:
+                # Batch trước đó đã commit server-side: cache danh sách file
+                # cũ đã stale dù tổng thể báo lỗi; báo luôn phần đã lên được
+                _invalidate_files_cache(session_state.session_id)
+                error_msg = (
+                    f"Một phần file đã upload thành công trước khi lỗi: {error_msg}"
+                )
             logger.error(f"Upload failed: {error_msg}")
             notify_error(error_msg)
             return False
@@ -571,14 +1075,17 @@ async def upload_temp_files(upload_event) -> bool:
         notify_error(f"Lỗi upload: {e}")
         return False
     finally:
-        # Xóa temp files sau khi upload xong
-        for t in temp_wrappers:
-            try:
-                if os.path.exists(t.path):
-                    os.remove(t.path)
-                    logger.info(f"Deleted temp file: {t.path}")
-            except Exception as e:
-                logger.warning(f"Không thể xóa temp file {t.path}: {e}")
+        # Xóa temp files sau khi upload xong (trừ file thuộc về NiceGUI);
+        # fan-out qua thread pool để batch lớn không unlink tuần tự trên event loop
+        own_paths = [
+            t.path for t in temp_wrappers
+            if t.path and not getattr(t, "_external", False)
+        ]
+        if own_paths:
+            await asyncio.gather(
+                *[asyncio.to_thread(_safe_unlink, p) for p in own_paths],
+                return_exceptions=True,
+            )
 
 def handle_login(email: str, password: str):
     email = (email or "").strip()
@@ -602,6 +1109,7 @@ def handle_login(email: str, password: str):
                 session_state.access_token = result.get("access_token", result["session_id"])
                 session_state.user = result.get("user")
                 session_state.chat_session_id = result.get("chat_session_id")
+                session_state._is_logged_in = True
                 save_session_to_storage()
                 
                 if client_ref:
@@ -665,8 +1173,9 @@ def handle_login(email: str, password: str):
     asyncio.create_task(login_async())
 
 
-def handle_register(username: str, email: str, password: str, confirm: str):
-    result = api_register(username, email, password, confirm)
+async def handle_register(username: str, email: str, password: str, confirm: str):
+    # Offload HTTP call để UI không đứng hình suốt RTT đăng ký
+    result = await asyncio.to_thread(api_register, username, email, password, confirm)
     if result.get("success"):
         notify_success(result.get("message", "Đăng ký thành công"))
         ui.navigate.to("/")
@@ -675,22 +1184,33 @@ def handle_register(username: str, email: str, password: str, confirm: str):
 
 
 def handle_logout():
+    _evict_verify_cache(session_state.session_id)
+    _invalidate_files_cache(session_state.session_id)
     if session_state.session_id:
+        # Fire-and-forget: logout phía client không cần chờ server ack,
+        # session phía server sẽ được dọn khi request này tới nơi
         try:
-            api_logout(session_state.session_id)
+            asyncio.get_running_loop().run_in_executor(None, api_logout, session_state.session_id)
+        except RuntimeError:
+            # Không có event loop (gọi ngoài context async) - gọi đồng bộ như cũ
+            try:
+                api_logout(session_state.session_id)
+            except Exception:
+                pass
         except Exception:
             pass
     session_state.session_id = None
     session_state.user = None
     session_state.selected_file = None
     session_state.chat_session_id = None
+    session_state._is_logged_in = False
     clear_session_storage()
     notify_success("Đã đăng xuất")
     ui.navigate.to("/login")
 
 def render_navbar():
     # Chỉ restore session nếu chưa login để tránh gọi API không cần thiết
-    if not session_state.is_logged_in:
+    if not session_state._is_logged_in:
         restore_session_from_storage()
     with ui.header().classes("items-center justify-between px-4"):
         ui.label("Trang quản trị viên").classes("text-lg font-bold")
@@ -698,7 +1218,7 @@ def render_navbar():
             ui.button("Trang chủ", on_click=lambda: ui.navigate.to("/")).props("flat")
             ui.button("Chat", on_click=lambda: ui.navigate.to("/chat")).props("flat")
             ui.button("Tài liệu", on_click=lambda: ui.navigate.to("/documents")).props("flat")
-            if session_state.is_logged_in:
+            if session_state._is_logged_in:
                 ui.button(
                     session_state.user.get("username") if session_state.user else "Đã đăng nhập",
                     on_click=lambda: ui.navigate.to("/profile"),
@@ -722,7 +1242,7 @@ def render_sidebar(include_file_select: bool = True):
     
     # Chỉ restore session nếu chưa login để tránh gọi API không cần thiết
     # Không blocking - chỉ check nhanh
-    if not session_state.is_logged_in:
+    if not session_state._is_logged_in:
         restore_session_from_storage()
 
     with ui.column().classes(
@@ -733,8 +1253,10 @@ def render_sidebar(include_file_select: bool = True):
             try:
                 new_text, new_files = await async_refresh_files_list()
                 if include_file_select and file_select is not None:
-                    new_options = ["Tất cả"] + new_files
-                    file_select.options = new_options
+                    new_options = _all_options(new_files)
+                    # Chỉ gán lại khi options thực sự thay đổi để tránh re-render thừa
+                    if file_select.options != new_options:
+                        file_select.options = new_options
                     # Giữ nguyên giá trị hiện tại nếu vẫn còn trong options
                     current_value = file_select.value
                     if current_value and current_value not in new_options:
@@ -750,8 +1272,9 @@ def render_sidebar(include_file_select: bool = True):
             try:
                 new_text, new_files = refresh_files_list()
                 if include_file_select and file_select is not None:
-                    new_options = ["Tất cả"] + new_files
-                    file_select.options = new_options
+                    new_options = _all_options(new_files)
+                    if file_select.options != new_options:
+                        file_select.options = new_options
                     current_value = file_select.value
                     if current_value and current_value not in new_options:
                         file_select.value = "Tất cả"
@@ -765,27 +1288,30 @@ def render_sidebar(include_file_select: bool = True):
             """Xử lý upload và refresh sau khi thành công - ngăn chặn reload trang và navigation"""
             try:
                 result = await upload_temp_files(e)
-                if result:      # Upload thành công
-                    # Chỉ refresh sidebar, không trigger navigation
-                    await asyncio.sleep(0.5)  # Giảm delay
-                    max_retries = 3  # Giảm số lần retry
-                    for retry in range(max_retries):
-                        try:
-                            new_files = await refresh_lists()
-                            if new_files:  # Có files rồi
-                                logger.info(f"Successfully refreshed file list after {retry + 1} attempts")
-                                # Force update UI - chỉ update sidebar, không navigate
-                                if file_select is not None:
-                                    file_select.update()
-                                # Refresh danh sách file xóa nếu đã được định nghĩa
-                                if hasattr(session_state, 'refresh_delete_file_list') and session_state.refresh_delete_file_list:
-                                    await session_state.refresh_delete_file_list()
-                                break
-                        except Exception as refresh_error:
-                            logger.warning(f"Error refreshing lists (retry {retry+1}): {refresh_error}")
-                        await asyncio.sleep(0.2)  # Giảm delay giữa các retry
-                    else:
-                        logger.warning("File list refresh completed but no files found")
+                if not result:
+                    return
+                # Response upload đã kèm danh sách file mới: cập nhật UI trực tiếp,
+                # không cần sleep + poll api_get_files nhiều lần nữa
+                files_payload = result.get("files") if isinstance(result, dict) else None
+                if files_payload and files_payload.get("success"):
+                    files = files_payload.get("files", [])
+                    session_state.file_chunks = {f["filename"]: f.get("chunks", 0) for f in files}
+                    new_files = [f["filename"] for f in files]
+                    if include_file_select and file_select is not None:
+                        new_options = _all_options(new_files)
+                        if file_select.options != new_options:
+                            file_select.options = new_options
+                        current_value = file_select.value
+                        if current_value and current_value not in new_options:
+                            file_select.value = "Tất cả"
+                        file_select.update()
+                    delete_file_select.options = new_files
+                    delete_file_select.update()
+                else:
+                    # Backend cũ không trả kèm danh sách file: refresh một lần
+                    await refresh_lists()
+                    if session_state.refresh_delete_file_list:
+                        await session_state.refresh_delete_file_list()
             except Exception as ex:
                 logger.error(f"Error in handle_upload: {ex}", exc_info=True)
                 notify_error(f"Lỗi khi xử lý upload: {ex}")
@@ -794,7 +1320,7 @@ def render_sidebar(include_file_select: bool = True):
         with ui.column().classes("gap-3 w-full"):
             if include_file_select:
                 file_select = ui.select(
-                    options=["Tất cả"] + file_names,
+                    options=_all_options(file_names),
                     value="Tất cả",
                     label="Chọn tài liệu để chat",
                 ).props("clearable dense").classes("w-full").style("font-size: 1rem")
@@ -829,19 +1355,15 @@ def render_sidebar(include_file_select: bool = True):
             async def load_files_async():
                 """Load files list async và cập nhật dropdown - không blocking UI"""
                 try:
-                    # Delay nhỏ để UI render trước
-                    await asyncio.sleep(0.1)
                     new_text, new_files = await async_refresh_files_list()
                     if include_file_select and file_select is not None:
-                        new_options = ["Tất cả"] + new_files
-                        file_select.options = new_options
-                        file_select.update()
+                        new_options = _all_options(new_files)
+                        if file_select.options != new_options:
+                            file_select.options = new_options
+                            file_select.update()
                         logger.info(f"Loaded {len(new_files)} files async")
                 except Exception as e:
                     logger.error(f"Error loading files async: {e}", exc_info=True)
-            
-            # Chạy async trong background, không block render
-            asyncio.create_task(load_files_async())
 
         ui.separator()
         
@@ -861,22 +1383,9 @@ def render_sidebar(include_file_select: bool = True):
                 nonlocal _is_refreshing_sidebar
                 try:
                     _is_refreshing_sidebar = True  # Set flag để ngăn navigation
-                    sessions_result = await asyncio.to_thread(api_get_chat_sessions, session_state.session_id)
+                    sessions_result = await _coalesced_call(api_get_chat_sessions, session_state.session_id)
                     if sessions_result.get("success"):
-                        sessions = sessions_result.get("sessions", [])
-                        options = {}
-                        for session in sessions:
-                            s_id = session.get("session_id")
-                            if not s_id:
-                                continue
-                            title = session.get("title", "Chat không có tiêu đề")
-                            time_str = session.get("updated_at") or session.get("created_at", "")
-                            
-                            display_text = f"{title[:30]}..." if len(title) > 30 else title
-                            if time_str:
-                                display_text += f" ({time_str})"
-                            options[s_id] = display_text
-                        
+                        options = _session_options(sessions_result.get("sessions", []))
                         chat_history_sidebar.options = options
                         
                         target_id = session_state.pending_load_history or session_state.chat_session_id
@@ -896,20 +1405,7 @@ def render_sidebar(include_file_select: bool = True):
                 try:
                     sessions_result = api_get_chat_sessions(session_state.session_id)
                     if sessions_result.get("success"):
-                        sessions = sessions_result.get("sessions", [])
-                        options = {}
-                        for session in sessions:
-                            s_id = session.get("session_id")
-                            if not s_id:
-                                continue
-                            title = session.get("title", "Chat không có tiêu đề")
-                            time_str = session.get("updated_at") or session.get("created_at", "")
-                            
-                            display_text = f"{title[:30]}..." if len(title) > 30 else title
-                            if time_str:
-                                display_text += f" ({time_str})"
-                            options[s_id] = display_text
-                        
+                        options = _session_options(sessions_result.get("sessions", []))
                         chat_history_sidebar.options = options
                         
                         target_id = session_state.pending_load_history or session_state.chat_session_id
@@ -956,11 +1452,6 @@ def render_sidebar(include_file_select: bool = True):
                         ui.timer(0.5, retry_load, once=True)
             
             chat_history_sidebar.on_value_change(on_sidebar_history_change)
-            # Load dữ liệu async ở background với delay để không block UI render
-            async def delayed_refresh():
-                await asyncio.sleep(0.2)  # Delay để UI render trước
-                await refresh_sidebar_history()
-            asyncio.create_task(delayed_refresh())
         
         ui.separator()
         
@@ -1004,6 +1495,7 @@ def render_sidebar(include_file_select: bool = True):
                             try:
                                 res = await asyncio.to_thread(api_delete_file, filename, session_state.session_id)
                                 if res.get("success"):
+                                    _invalidate_files_cache(session_state.session_id)
                                     notify_success(res.get("message", "Đã xóa file thành công"))
                                     # Refresh danh sách file sau khi xóa
                                     await refresh_delete_file_list()
@@ -1040,6 +1532,7 @@ def render_sidebar(include_file_select: bool = True):
                             try:
                                 res = await asyncio.to_thread(api_clear_all_files, session_state.session_id)
                                 if res.get("success"):
+                                    _invalidate_files_cache(session_state.session_id)
                                     notify_success(res.get("message", "Đã xóa toàn bộ tài liệu thành công"))
                                     # Refresh danh sách file sau khi xóa
                                     await refresh_delete_file_list()
@@ -1066,12 +1559,78 @@ def render_sidebar(include_file_select: bool = True):
                     on_click=show_clear_all_confirm
                 ).props("outline dense").classes("w-full").style("font-size: 0.85rem")
             
-            # Load danh sách file khi sidebar được render
-            asyncio.create_task(refresh_delete_file_list())
-        
+        async def _initial_sidebar_load():
+            """Load dữ liệu sidebar bằng một request bundle duy nhất
+            (verify + files + sessions) thay vì 3 roundtrip riêng lẻ."""
+            nonlocal _is_refreshing_sidebar
+            pending_history = session_state.pending_load_history
+            try:
+                bundle = await asyncio.to_thread(
+                    api_get_sidebar_bundle, session_state.session_id, pending_history
+                )
+            except Exception as e:
+                logger.error(f"Error loading sidebar bundle: {e}", exc_info=True)
+                bundle = {}
+            if not bundle.get("success"):
+                # Fallback: endpoint bundle lỗi thì gọi song song như cũ.
+                # Không có file_select thì load_files_async chỉ ném kết quả đi,
+                # khỏi tốn một roundtrip cho nó.
+                tasks = [refresh_sidebar_history(), refresh_delete_file_list()]
+                if include_file_select:
+                    tasks.append(load_files_async())
+                await asyncio.gather(*tasks)
+                if pending_history and session_state.load_chat_history:
+                    session_state.pending_load_history = None
+                    session_state.load_chat_history(pending_history)
+                return
+
+            verify = bundle.get("verify") or {}
+            if verify.get("valid"):
+                session_state.user = verify.get("user") or session_state.user
+                if not session_state.chat_session_id:
+                    session_state.chat_session_id = verify.get("chat_session_id")
+                session_state._is_logged_in = True
+
+            files_payload = bundle.get("files") or {}
+            files = files_payload.get("files", [])
+            session_state.file_chunks = {f["filename"]: f.get("chunks", 0) for f in files}
+            new_files = [f["filename"] for f in files]
+            if include_file_select and file_select is not None:
+                new_options = _all_options(new_files)
+                if file_select.options != new_options:
+                    file_select.options = new_options
+                    file_select.update()
+            delete_file_select.options = new_files
+            delete_file_select.update()
+
+            sessions_payload = bundle.get("sessions") or {}
+            try:
+                _is_refreshing_sidebar = True
+                options = _session_options(sessions_payload.get("sessions", []))
+                chat_history_sidebar.options = options
+                target_id = session_state.pending_load_history or session_state.chat_session_id
+                if target_id and target_id in options and chat_history_sidebar.value != target_id:
+                    chat_history_sidebar.value = target_id
+                chat_history_sidebar.update()
+            finally:
+                _is_refreshing_sidebar = False
+
+            # Lịch sử chat đã kèm sẵn trong bundle: render thẳng, không cần
+            # ui.timer(0.3) + api_get_chat_history như trước
+            history_payload = bundle.get("history") or {}
+            if pending_history and session_state.load_chat_history:
+                session_state.pending_load_history = None
+                if history_payload.get("success"):
+                    session_state.load_chat_history(pending_history, history_payload.get("messages", []))
+                else:
+                    session_state.load_chat_history(pending_history)
+
+        # Chạy async trong background, không block render
+        asyncio.create_task(_initial_sidebar_load())
+
         ui.separator()
         with ui.card().classes("w-full shadow-none border p-3 gap-2"):
-            if session_state.is_logged_in and session_state.user:
+            if session_state._is_logged_in and session_state.user:
                 ui.label(f"👤 {session_state.user.get('username','')}").classes("text-sm font-semibold")
                 ui.label(session_state.user.get("email","")).classes("text-xs text-gray-600")
                 ui.button("Hồ sơ", on_click=lambda: ui.navigate.to("/profile")).props("outline").classes("w-full")
@@ -1094,7 +1653,7 @@ def render_shell(include_file_select: bool, content_builder):
 @ui.page("/")
 def home_page():
     # Kiểm tra auth nhanh, không blocking
-    if not session_state.is_logged_in:
+    if not session_state._is_logged_in:
         # Thử restore session nhanh từ storage (không verify)
         user_store = _get_user_store()
         if user_store:
@@ -1104,14 +1663,11 @@ def home_page():
                 session_state.access_token = stored_session
                 session_state.user = user_store.get("user")
                 session_state.chat_session_id = user_store.get("chat_session_id")
+                session_state._is_logged_in = True
         
         # Nếu vẫn chưa login, redirect
-        if not session_state.is_logged_in:
-            ui.add_head_html(
-                '<script>window.location.href = "/login";</script>',
-                shared=False
-            )
-            ui.label("Đang chuyển đến trang đăng nhập...").classes("text-center p-4")
+        if not session_state._is_logged_in:
+            _redirect_to_login()
             return
     
     def build_content(file_select):
@@ -1148,110 +1704,6 @@ def home_page():
         msg_input = None
         send_btn = None
 
-        def format_text(text: str) -> str:
-            """Format text với markdown và MathJax support"""
-            import re
-            import html
-
-            text = re.sub(r'strong>', '<strong>', text)
-            text = re.sub(r'</strong>', '</strong>', text)
-
-            lines = text.split('\n')
-            formatted_lines = []
-            in_blockquote = False
-            in_math_formula = False
-            math_lines = []
-
-            math_chars = ['∑', '∫', '=', '≤', '≥', '≠', '±', '×', '÷', 'α', 'β', 'γ', 'δ', 'ε', 'θ', 'λ', 'μ', 'π', 'σ', 'φ', 'ω', 'Δ', 'Ω', '∞']
-
-            for i, line in enumerate(lines):
-                stripped = line.strip()
-
-                if stripped.startswith('>'):
-                    content = stripped[1:].strip()
-                    is_math = any(char in content for char in math_chars) or \
-                             re.search(r'[a-z]_[a-z]', content) or \
-                             re.search(r'[A-Z][a-z]+[A-Z]', content) or \
-                             (i > 0 and lines[i-1].strip().startswith('>') and in_math_formula)
-
-                    if is_math:
-                        if not in_math_formula:
-                            in_math_formula = True
-                            math_lines = []
-                        math_lines.append(content)
-                    else:
-                        if in_math_formula:
-                            math_content = '\n'.join(math_lines)
-                            formatted_lines.append(f'<div class="math-formula">{html.escape(math_content)}</div>')
-                            in_math_formula = False
-                            math_lines = []
-
-                        if not in_blockquote:
-                            formatted_lines.append('<blockquote>')
-                            in_blockquote = True
-                        formatted_lines.append(f'<p>{html.escape(content)}</p>')
-                    continue
-                else:
-                    if in_math_formula:
-                        math_content = '\n'.join(math_lines)
-                        formatted_lines.append(f'<div class="math-formula">{html.escape(math_content)}</div>')
-                        in_math_formula = False
-                        math_lines = []
-
-                    if in_blockquote:
-                        formatted_lines.append('</blockquote>')
-                        in_blockquote = False
-
-                    formatted_lines.append(line)
-
-            if in_math_formula:
-                math_content = '\n'.join(math_lines)
-                formatted_lines.append(f'<div class="math-formula">{html.escape(math_content)}</div>')
-            if in_blockquote:
-                formatted_lines.append('</blockquote>')
-
-            text = '\n'.join(formatted_lines)
-            has_html_tags = bool(re.search(r'<(strong|em|ul|li|h[1-6]|blockquote|div|p|code)[^>]*>', text, re.IGNORECASE))
-
-            if not has_html_tags:
-                def replace_bold(match):
-                    bold_text = match.group(1)
-                    if '<strong>' in bold_text or '</strong>' in bold_text:
-                        return match.group(0)
-                    return f'<strong>{html.escape(bold_text)}</strong>'
-
-                text = re.sub(r'\*\*([^*]+?)\*\*', replace_bold, text)
-                text = re.sub(r'(?<!\*)\*([^*]+?)\*(?!\*)', r'<em>\1</em>', text)
-                text = re.sub(r'`([^`]+?)`', r'<code style="background: #f4f4f4; padding: 2px 6px; border-radius: 3px; font-family: monospace;">\1</code>', text)
-                text = re.sub(r'^-\s+(.+)$', r'<li style="margin: 0.3em 0;">\1</li>', text, flags=re.MULTILINE)
-                text = re.sub(r'(<li[^>]*>.*?</li>(?:\s*<li[^>]*>.*?</li>)*)', r'<ul style="margin: 0.5em 0; padding-left: 1.5em;">\1</ul>', text, flags=re.DOTALL)
-                text = re.sub(r'^###\s+(.+)$', r'<h3 style="font-size: 1.2em; font-weight: bold; margin: 1em 0 0.5em 0; color: #333;">\1</h3>', text, flags=re.MULTILINE)
-                text = re.sub(r'^##\s+(.+)$', r'<h2 style="font-size: 1.4em; font-weight: bold; margin: 1.2em 0 0.6em 0; color: #222;">\1</h2>', text, flags=re.MULTILINE)
-                text = re.sub(r'^#\s+(.+)$', r'<h1 style="font-size: 1.6em; font-weight: bold; margin: 1.5em 0 0.8em 0; color: #111;">\1</h1>', text, flags=re.MULTILINE)
-
-            paragraphs = re.split(r'\n\s*\n', text)
-            formatted_paragraphs = []
-            for para in paragraphs:
-                para = para.strip()
-                if not para:
-                    continue
-
-                has_html_tags = bool(re.search(r'<(strong|em|ul|li|h[1-6]|blockquote|div|p|code)[^>]*>', para, re.IGNORECASE))
-
-                if has_html_tags:
-                    formatted_paragraphs.append(para)
-                elif para.startswith('<') and (para.startswith('<h') or para.startswith('<ul') or para.startswith('<blockquote') or para.startswith('<div')):
-                    formatted_paragraphs.append(para)
-                else:
-                    para_escaped = html.escape(para)
-                    para_escaped = para_escaped.replace('\n', '<br>')
-                    formatted_paragraphs.append(f'<p style="margin: 0.5em 0; line-height: 1.6;">{para_escaped}</p>')
-
-            formatted = '\n'.join(formatted_paragraphs)
-            formatted = re.sub(r'<br>\s*<br>+', '<br>', formatted)
-
-            return formatted
-
         @ui.refreshable
         def chat_messages_view():
             if chat_entries:
@@ -1283,7 +1735,8 @@ def home_page():
                 })();
             ''')
 
-        def add_message(role: str, text: str, stamp: Optional[str] = None, pending: bool = False) -> str:
+        def add_message(role: str, text: str, stamp: Optional[str] = None, pending: bool = False,
+                        refresh: bool = True) -> str:
             msg_id = str(uuid4())
             entry = {
                 "id": msg_id,
@@ -1296,69 +1749,89 @@ def home_page():
                 "pending": pending,
             }
             chat_entries.append(entry)
-            chat_messages_view.refresh()
+            # refresh=False cho phép gom nhiều message vào một lần refresh duy nhất
+            # (một WebSocket frame thay vì một frame cho mỗi message)
+            if refresh:
+                chat_messages_view.refresh()
             return msg_id
 
-        def update_message(msg_id: str, new_text: str, new_stamp: Optional[str] = None, pending: bool = False):
+        def _apply_message_update(msg_id: str, new_text: str, formatted: Optional[str],
+                                  new_stamp: Optional[str], pending: bool):
             for entry in chat_entries:
                 if entry["id"] == msg_id:
                     entry["text"] = new_text
-                    entry["html"] = format_text(new_text) if entry["role"] != "user" else None
+                    entry["html"] = formatted if entry["role"] != "user" else None
                     entry["stamp"] = new_stamp or entry.get("stamp") or datetime.now().strftime("%H:%M")
                     entry["pending"] = pending
                     break
             chat_messages_view.refresh()
 
-        def load_chat_history(chat_session_id: str):
+        def update_message(msg_id: str, new_text: str, new_stamp: Optional[str] = None, pending: bool = False):
+            _apply_message_update(msg_id, new_text, format_text(new_text), new_stamp, pending)
+
+        async def update_message_async(msg_id: str, new_text: str, new_stamp: Optional[str] = None,
+                                       pending: bool = False):
+            """Như update_message nhưng chạy format_text trong worker thread
+            để response dài không chặn event loop của NiceGUI.
+
+            Render dở dang (pending=True, buffer đang stream lớn dần) không đi
+            qua cache memoize: mỗi partial chỉ xuất hiện đúng một lần nên cache
+            chỉ bị chiếm chỗ vô ích; bản final mới đáng lưu lại."""
+            fmt = _format_text_impl if pending else format_text
+            formatted = await asyncio.to_thread(fmt, new_text)
+            _apply_message_update(msg_id, new_text, formatted, new_stamp, pending)
+
+        def load_chat_history(chat_session_id: str, messages: Optional[List[dict]] = None):
             if not chat_session_id:
                 return
 
             chat_entries.clear()
-            history_result = api_get_chat_history(chat_session_id, session_state.session_id)
-            print(f"DEBUG: Loaded chat history (session {chat_session_id}): {history_result}")
-
-            if history_result.get("success"):
+            if messages is None:
+                # Chưa có sẵn messages (từ bundle) thì mới gọi API riêng
+                history_result = api_get_chat_history(chat_session_id, session_state.session_id)
+                print(f"DEBUG: Loaded chat history (session {chat_session_id}): {history_result}")
+                if not history_result.get("success"):
+                    notify_error(history_result.get("message", "Không thể tải lịch sử chat"))
+                    return
                 messages = history_result.get("messages", [])
-                
-                # Console.log toàn bộ data của chat-session để kiểm tra
-                print("=" * 80)
-                print(f"CHAT SESSION DATA - Session ID: {chat_session_id}")
-                print("=" * 80)
-                print(f"Total messages: {len(messages)}")
-                print(f"Full session data: {json.dumps(history_result, indent=2, ensure_ascii=False)}")
-                print("\nMessages breakdown:")
-                user_count = 0
-                agent_count = 0
-                for idx, msg in enumerate(messages):
+
+            # Console.log toàn bộ data của chat-session để kiểm tra
+            print("=" * 80)
+            print(f"CHAT SESSION DATA - Session ID: {chat_session_id}")
+            print("=" * 80)
+            print(f"Total messages: {len(messages)}")
+            print(f"Full session data: {json.dumps(messages, indent=2, ensure_ascii=False)}")
+            print("\nMessages breakdown:")
+            user_count = 0
+            agent_count = 0
+            for idx, msg in enumerate(messages):
+                role = msg.get("role", "assistant")
+                if role == "user":
+                    user_count += 1
+                elif role == "assistant":
+                    agent_count += 1
+                print(f"  [{idx+1}] Role: {role}, Content length: {len(msg.get('content', ''))}, Created: {msg.get('created_at')}")
+            print(f"\nSummary: {user_count} User messages, {agent_count} Agent messages")
+            print("=" * 80)
+
+            if messages:
+                # Thêm tất cả message rồi mới refresh một lần để tránh
+                # gửi một WebSocket frame cho từng message
+                for msg in messages:
                     role = msg.get("role", "assistant")
-                    if role == "user":
-                        user_count += 1
-                    elif role == "assistant":
-                        agent_count += 1
-                    print(f"  [{idx+1}] Role: {role}, Content length: {len(msg.get('content', ''))}, Created: {msg.get('created_at')}")
-                print(f"\nSummary: {user_count} User messages, {agent_count} Agent messages")
-                print("=" * 80)
-                
-                if messages:
-                    for msg in messages:
-                        role = msg.get("role", "assistant")
-                        content = msg.get("content", "")
-                        if content:
-                            add_message(role, content, stamp=msg.get("created_at"))
-                    session_state.chat_session_id = chat_session_id
-                    ui.notify(f"Đã tải {len(messages)} tin nhắn từ lịch sử ({user_count} User, {agent_count} Agent)", type="positive")
-                else:
-                    ui.notify("Không có tin nhắn trong session này", type="info")
+                    content = msg.get("content", "")
+                    if content:
+                        add_message(role, content, stamp=msg.get("created_at"), refresh=False)
+                chat_messages_view.refresh()
+                session_state.chat_session_id = chat_session_id
+                ui.notify(f"Đã tải {len(messages)} tin nhắn từ lịch sử ({user_count} User, {agent_count} Agent)", type="positive")
             else:
-                notify_error(history_result.get("message", "Không thể tải lịch sử chat"))
-        
-        # Lưu reference của load_chat_history vào session_state để có thể gọi từ sidebar
-        session_state.load_chat_history = load_chat_history
+                ui.notify("Không có tin nhắn trong session này", type="info")
 
-        if session_state.pending_load_history:
-            load_session_id = session_state.pending_load_history
-            session_state.pending_load_history = None
-            ui.timer(0.3, lambda: load_chat_history(load_session_id), once=True)
+        # Lưu reference của load_chat_history vào session_state để có thể gọi từ sidebar.
+        # Khi có pending_load_history thì không cần timer + roundtrip riêng nữa:
+        # _initial_sidebar_load sẽ nhận messages kèm trong bundle và gọi hàm này trực tiếp.
+        session_state.load_chat_history = load_chat_history
 
         async def ensure_chat_session():
             if not session_state.chat_session_id and session_state.session_id:
@@ -1372,7 +1845,8 @@ def home_page():
                 return
             await ensure_chat_session()
 
-            add_message("user", message)
+            # Message của user sẽ được refresh cùng lúc với pending message bên dưới
+            add_message("user", message, refresh=False)
             selected = file_select.value if file_select else None
             if selected == "Tất cả" or not selected:
                 selected = None
@@ -1386,47 +1860,83 @@ def home_page():
             pending_id = add_message("assistant", "Đang tìm kiếm câu trả lời...", pending=True)
 
             try:
-                resp = await asyncio.to_thread(
-                    api_chat_send,
-                    message,
-                    session_state.session_id,
-                    selected_file=selected,
-                    chat_session_id=session_state.chat_session_id,
-                )
-                print("chat_response_home:", resp)
-                if resp.get("success"):
-                    bot = resp.get("response", "Không có phản hồi")
-                    session_state.chat_session_id = resp.get("chat_session_id", session_state.chat_session_id)
-                    update_message(pending_id, bot, new_stamp=datetime.now().strftime("%H:%M"))
-                    
-                    # Log để kiểm tra xem backend có lưu cả User và Agent messages không
-                    print("=" * 80)
-                    print("AFTER SENDING MESSAGE - Checking if messages are saved:")
-                    print(f"User message: {message}")
-                    print(f"Agent response: {bot[:100]}..." if len(bot) > 100 else f"Agent response: {bot}")
-                    print(f"Chat session ID: {session_state.chat_session_id}")
-                    
-                    # Verify messages are saved by fetching history
-                    if session_state.chat_session_id:
-                        verify_history = api_get_chat_history(session_state.chat_session_id, session_state.session_id)
-                        if verify_history.get("success"):
-                            verify_messages = verify_history.get("messages", [])
-                            user_msgs = [m for m in verify_messages if m.get("role") == "user"]
-                            agent_msgs = [m for m in verify_messages if m.get("role") == "assistant"]
-                            print(f"Verification: {len(user_msgs)} User messages, {len(agent_msgs)} Agent messages in DB")
-                            print(f"Latest User message: {user_msgs[-1].get('content', '')[:50] if user_msgs else 'None'}...")
-                            print(f"Latest Agent message: {agent_msgs[-1].get('content', '')[:50] if agent_msgs else 'None'}...")
-                        else:
-                            print(f"Warning: Could not verify messages - {verify_history.get('message', 'Unknown error')}")
-                    print("=" * 80)
-                    
-                    if hasattr(session_state, 'refresh_sidebar_history'):
+                # Stream câu trả lời: backend trả NDJSON từng delta, render dần
+                # vào pending message thay vì chờ trọn response rồi mới format
+                loop = asyncio.get_running_loop()
+                queue: asyncio.Queue = asyncio.Queue()
+
+                def _pump():
+                    for event in api_chat_send_stream(
+                        message,
+                        session_state.session_id,
+                        selected_file=selected,
+                        chat_session_id=session_state.chat_session_id,
+                    ):
+                        loop.call_soon_threadsafe(queue.put_nowait, event)
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+
+                pump_task = loop.run_in_executor(None, _pump)
+
+                buf = []
+                done_event = None
+                stream_error = None
+                last_render = 0.0
+                while True:
+                    event = await queue.get()
+                    if event is None:
+                        break
+                    if event.get("error"):
+                        stream_error = event["error"]
+                        continue
+                    if event.get("delta"):
+                        buf.append(event["delta"])
+                        now = time.monotonic()
+                        # Throttle ~200ms/lần để không format + đẩy WebSocket
+                        # frame cho từng token một
+                        if now - last_render >= 0.2:
+                            last_render = now
+                            await update_message_async(pending_id, ''.join(buf), pending=True)
+                    if event.get("done"):
+                        done_event = event
+                await pump_task
+
+                if stream_error and not buf:
+                    # Endpoint stream lỗi mà chưa nhận được gì: fallback về
+                    # bản non-stream như cũ
+                    resp = await asyncio.to_thread(
+                        api_chat_send,
+                        message,
+                        session_state.session_id,
+                        selected_file=selected,
+                        chat_session_id=session_state.chat_session_id,
+                    )
+                    if resp.get("success"):
+                        bot = resp.get("response", "Không có phản hồi")
+                        session_state.chat_session_id = resp.get("chat_session_id", session_state.chat_session_id)
+                        await update_message_async(pending_id, bot, new_stamp=datetime.now().strftime("%H:%M"))
+                        if session_state.refresh_sidebar_history:
+                            await session_state.refresh_sidebar_history()
+                        ui.notify("Đã nhận câu trả lời", type="positive")
+                    else:
+                        err = resp.get("message") or resp.get("response") or stream_error
+                        update_message(pending_id, err, pending=False, new_stamp=datetime.now().strftime("%H:%M"))
+                        notify_error(err)
+                elif stream_error:
+                    # Lỗi giữa chừng sau khi đã nhận một phần delta: giữ phần
+                    # đã stream nhưng đánh dấu bị cắt và báo lỗi thay vì toast
+                    # thành công trên câu trả lời cụt
+                    bot = ''.join(buf) + "\n\n*(Câu trả lời bị gián đoạn do lỗi)*"
+                    await update_message_async(pending_id, bot, new_stamp=datetime.now().strftime("%H:%M"))
+                    notify_error(stream_error)
+                else:
+                    bot = ''.join(buf) or "Không có phản hồi"
+                    if done_event and done_event.get("chat_session_id"):
+                        session_state.chat_session_id = done_event["chat_session_id"]
+                    await update_message_async(pending_id, bot, new_stamp=datetime.now().strftime("%H:%M"))
+
+                    if session_state.refresh_sidebar_history:
                         await session_state.refresh_sidebar_history()
                     ui.notify("Đã nhận câu trả lời", type="positive")
-                else:
-                    err = resp.get("message") or resp.get("response") or "Lỗi khi gửi tin nhắn"
-                    update_message(pending_id, err, pending=False, new_stamp=datetime.now().strftime("%H:%M"))
-                    notify_error(err)
             finally:
                 if msg_input is not None:
                     msg_input.value = ""
@@ -1460,7 +1970,7 @@ def home_page():
 def login_page():
     with ui.row().classes("w-full min-h-screen items-center justify-center bg-gray-50"):
         with ui.column().classes("items-center justify-center gap-4 w-full max-w-md"):
-            ui.markdown("## Đăng nhập").classes("self-center")
+            ui.html("<h2 class='text-2xl font-bold'>Đăng nhập</h2>").classes("self-center")
             with ui.card().classes("gap-3 w-full p-6 shadow-md").style("border: 1px solid #ccc"):
                 email = ui.input("Email").classes("w-full")
                 
@@ -1501,7 +2011,7 @@ def login_page():
 def register_page():
     with ui.row().classes("w-full min-h-screen items-center justify-center bg-gray-50"):
         with ui.column().classes("items-center justify-center gap-4 w-full max-w-md"):
-            ui.markdown("## Đăng ký").classes("self-center")
+            ui.html("<h2 class='text-2xl font-bold'>Đăng ký</h2>").classes("self-center")
             with ui.card().classes("gap-3 w-full p-6 shadow-md").style("border: 1px solid #ccc"):
                 username = ui.input("Tên đăng nhập").classes("w-full")
                 email = ui.input("Email").classes("w-full")
@@ -1520,12 +2030,12 @@ def register_page():
 def forgot_page():
     with ui.row().classes("w-full min-h-screen items-center justify-center bg-gray-50"):
         with ui.column().classes("items-center justify-center gap-4 w-full max-w-md"):
-            ui.markdown("## Quên mật khẩu").classes("self-center")
+            ui.html("<h2 class='text-2xl font-bold'>Quên mật khẩu</h2>").classes("self-center")
             with ui.card().classes("gap-3 w-full p-6 shadow-md").style("border: 1px solid #ccc"):
                 email = ui.input("Email đã đăng ký").classes("w-full")
 
-                def submit():
-                    res = api_forgot_password(email.value)
+                async def submit():
+                    res = await asyncio.to_thread(api_forgot_password, email.value)
                     msg = res.get("message", "Đã gửi yêu cầu")
                     if "thành công" in msg.lower() or "✅" in msg:
                         notify_success(msg)
@@ -1538,16 +2048,16 @@ def forgot_page():
 
 @ui.page("/reset-password")
 def reset_page():
-    ui.markdown("## Đặt lại mật khẩu")
+    ui.html("<h2 class='text-2xl font-bold'>Đặt lại mật khẩu</h2>")
     token = ui.input("Mã OTP").classes("w-96")
     new_pass = ui.input("Mật khẩu mới", password=True).classes("w-96")
     confirm = ui.input("Xác nhận mật khẩu mới", password=True).classes("w-96")
 
-    def submit():
+    async def submit():
         if new_pass.value != confirm.value:
             notify_error("Mật khẩu xác nhận không khớp")
             return
-        res = api_reset_password(token.value, new_pass.value, confirm.value)
+        res = await asyncio.to_thread(api_reset_password, token.value, new_pass.value, confirm.value)
         if res.get("success"):
             notify_success(res.get("message", "Đặt lại mật khẩu thành công"))
             ui.navigate.to("/login")
@@ -1563,71 +2073,132 @@ def documents_page():
     if not require_auth():
         return
     render_navbar()
-    ui.markdown("## Quản lý tài liệu")
+    ui.html("<h2 class='text-2xl font-bold'>Quản lý tài liệu</h2>")
 
     files_container = ui.column().classes("w-full gap-2")
     filename_dropdown = ui.select(options=[], label="Chọn file để xóa").props("clearable").classes("w-80")
 
-    def refresh():
-        result = api_get_files(session_state.session_id)
-        files_container.clear()
-        
+    # HTML của lần render trước: danh sách không đổi thì khỏi clear + chèn lại DOM
+    last_rendered = {"html": None}
+
+    def refresh(result=None):
+        # Caller đã có sẵn payload danh sách file (vd: response upload) thì
+        # render thẳng, không gọi thêm API
+        if result is None:
+            result = api_get_files(session_state.session_id)
+
         if not result.get("success") or result.get("total_files", 0) == 0:
-            with files_container:
-                ui.label("Chưa có file nào được upload.").classes("text-gray-500")
+            if last_rendered["html"] != "":
+                files_container.clear()
+                with files_container:
+                    ui.label("Chưa có file nào được upload.").classes("text-gray-500")
+                last_rendered["html"] = ""
             filename_dropdown.options = []
-            return
-        
+            return result
+
         files = result.get("files", [])
-        filename_dropdown.options = [file["filename"] for file in files]
-        
-        with files_container:
-            ui.markdown(f"### Tổng số: {result['total_files']} tài liệu, {result['total_chunks']} chunks")
-            
-            for file in files:
-                with ui.card().classes("w-full p-4 gap-2"):
-                    with ui.row().classes("items-center justify-between w-full"):
-                        with ui.column().classes("gap-1"):
-                            ui.label(f"📄 {file['filename']}").classes("text-lg font-semibold")
-                            ui.label(f"{file['chunks']} chunks").classes("text-sm text-gray-600")
-                        
-                        with ui.row().classes("gap-2"):
-                            # Nút view PDF
-                            def view_pdf(fname=file['filename']):
-                                view_result = api_view_file(fname, session_state.session_id)
-                                if view_result.get("success"):
-                                    url = view_result.get("url")
-                                    ui.run_javascript(f'window.open("{url}", "_blank")')
-                                else:
-                                    notify_error(view_result.get("message", "Không thể xem file"))
-                            
-                            ui.button("👁️ Xem PDF", on_click=lambda f=file['filename']: view_pdf(f)).props("outline type=button")
-                            
-                            # Nút xóa
-                            def delete_file(fname=file['filename']):
-                                res = api_delete_file(fname, session_state.session_id)
-                                if res.get("success"):
-                                    notify_success(res.get("message", "Đã xóa file"))
-                                    refresh()
-                                else:
-                                    notify_error(res.get("message", "Không thể xóa file"))
-                            
-                            ui.button("🗑️ Xóa", color="negative", on_click=lambda f=file['filename']: delete_file(f)).props("outline type=button")
+        new_options = [file["filename"] for file in files]
+        if filename_dropdown.options != new_options:
+            filename_dropdown.options = new_options
+
+        # Dựng cả danh sách thành một chuỗi HTML và chèn DOM một lần thay vì
+        # ~7 component NiceGUI cho mỗi file; các nút bắn emitEvent về đúng một
+        # handler 'file_action' đăng ký bên dưới
+        btn_cls = "px-3 py-1 border rounded text-sm font-medium hover:bg-gray-100"
+        parts = [
+            f"<h3 class='text-xl font-bold'>Tổng số: {result['total_files']} tài liệu, {result['total_chunks']} chunks</h3>",
+            "<div class='flex flex-col gap-2 w-full'>",
+        ]
+        for file in files:
+            fname = file['filename']
+            # URL Cloudinary đã có sẵn trong danh sách file: nút Xem mở thẳng
+            # bằng JS, không tốn một RTT api_view_file mỗi lần bấm; chỉ file
+            # thiếu URL mới đi vòng qua handler 'file_action'
+            view_url = file.get('cloudinary_url')
+            if view_url:
+                onclick_view = _escape(
+                    "window.open(" + json.dumps(view_url) + ", '_blank')"
+                )
+            else:
+                onclick_view = _escape(
+                    "emitEvent('file_action', " + json.dumps({"action": "view", "fname": fname}, ensure_ascii=False) + ")"
+                )
+            onclick_delete = _escape(
+                "emitEvent('file_action', " + json.dumps({"action": "delete", "fname": fname}, ensure_ascii=False) + ")"
+            )
+            parts.append(
+                "<div class='w-full p-4 border rounded-lg shadow-sm flex items-center justify-between bg-white'>"
+                f"<div><div class='text-lg font-semibold'>📄 {_escape(fname)}</div>"
+                f"<div class='text-sm text-gray-600'>{file.get('chunks', 0)} chunks</div></div>"
+                "<div class='flex gap-2'>"
+                f"<button type='button' class='{btn_cls}' onclick=\"{onclick_view}\">👁️ Xem PDF</button>"
+                f"<button type='button' class='{btn_cls} text-red-600 border-red-400' onclick=\"{onclick_delete}\">🗑️ Xóa</button>"
+                "</div></div>"
+            )
+        parts.append("</div>")
+
+        new_html = ''.join(parts)
+        if new_html != last_rendered["html"]:
+            files_container.clear()
+            with files_container:
+                ui.html(new_html)
+            last_rendered["html"] = new_html
+        return result
+
+    async def handle_file_action(e):
+        """Handler chung cho các nút trong danh sách file HTML"""
+        args = e.args or {}
+        fname = args.get('fname')
+        if not fname:
+            return
+        if args.get('action') == 'view':
+            view_result = await asyncio.to_thread(api_view_file, fname, session_state.session_id)
+            if view_result.get("success"):
+                url = view_result.get("url")
+                ui.run_javascript(f'window.open("{url}", "_blank")')
+            else:
+                notify_error(view_result.get("message", "Không thể xem file"))
+        elif args.get('action') == 'delete':
+            res = await asyncio.to_thread(api_delete_file, fname, session_state.session_id)
+            if res.get("success"):
+                _invalidate_files_cache(session_state.session_id)
+                notify_success(res.get("message", "Đã xóa file"))
+                refresh()
+            else:
+                notify_error(res.get("message", "Không thể xóa file"))
+
+    ui.on('file_action', handle_file_action)
 
     ui.button("🔄 Làm mới danh sách", on_click=refresh).props("type=button").classes("mb-4")
 
-    ui.markdown("### Upload mới")
+    ui.html("<h3 class='text-xl font-bold'>Upload mới</h3>")
     
+    # ui.upload với multiple=True fire on_upload cho TỪNG file: debounce để cả
+    # burst chỉ tốn một lượt refresh thay vì N lượt poll api_get_files
+    refresh_debounce = {"task": None}
+
+    async def _debounced_refresh(files_payload):
+        """Đợi burst on_upload lắng xuống rồi render danh sách file một lần."""
+        await asyncio.sleep(0.2)
+        # Server commit xong mới trả lời (indexed=True) và đã kèm danh sách
+        # file mới trong response - render thẳng, không sleep/retry poll nữa
+        refresh(files_payload)
+        logger.info("Refreshed documents page after upload")
+
     async def handle_documents_upload(e):
         """Xử lý upload trong trang documents - ngăn chặn reload trang"""
         try:
             result = await upload_temp_files(e)
             if result:  # Upload thành công
-                await asyncio.sleep(1.5)
-                for retry in range(3):
-                    refresh()
-                    await asyncio.sleep(0.5)
-                logger.info("Refreshed documents page after upload")
+                files_payload = None
+                if isinstance(result, dict) and result.get("indexed"):
+                    files_payload = result.get("files") or None
+                # File tiếp theo trong burst tới thì hủy refresh đang chờ,
+                # lên lịch lại với snapshot danh sách file mới nhất
+                task = refresh_debounce["task"]
+                if task is not None and not task.done():
+                    task.cancel()
+                refresh_debounce["task"] = asyncio.create_task(_debounced_refresh(files_payload))
         except Exception as ex:
             logger.error(f"Error in handle_documents_upload: {ex}", exc_info=True)
             notify_error(f"Lỗi khi xử lý upload: {ex}")
@@ -1659,20 +2230,22 @@ def documents_page():
     # Chạy sau khi component được render
     ui.timer(0.1, prevent_documents_form_submit, once=True)
 
-    def delete_selected():
+    async def delete_selected():
         if not filename_dropdown.value:
             notify_error("Vui lòng chọn file cần xóa")
             return
-        res = api_delete_file(filename_dropdown.value, session_state.session_id)
+        res = await asyncio.to_thread(api_delete_file, filename_dropdown.value, session_state.session_id)
         if res.get("success"):
+            _invalidate_files_cache(session_state.session_id)
             notify_success(res.get("message", "Đã xóa file"))
             refresh()
         else:
             notify_error(res.get("message", "Không thể xóa file"))
 
-    def clear_all():
-        res = api_clear_all_files(session_state.session_id)
+    async def clear_all():
+        res = await asyncio.to_thread(api_clear_all_files, session_state.session_id)
         if res.get("success"):
+            _invalidate_files_cache(session_state.session_id)
             notify_success(res.get("message", "Đã xóa toàn bộ tài liệu"))
             refresh()
         else:
@@ -1696,7 +2269,7 @@ def admin_page():
         return
 
     render_navbar()
-    ui.markdown("## Trang quản trị").classes("px-6 pt-4")
+    ui.html("<h2 class='text-2xl font-bold'>Trang quản trị</h2>").classes("px-6 pt-4")
     
     # Helper function để hiển thị notification từ async context
     def admin_notify(msg: str, notify_type: str = "positive"):
@@ -1815,30 +2388,30 @@ def admin_page():
                     last_msg = None
                     errors = []
                     
-                    for row in rows:
+                    # Fan-out các request xóa song song: N user tốn ~1 RTT thay vì N
+                    responses = await asyncio.gather(
+                        *[
+                            async_api_request("POST", "/admin/users/delete/", {"user_id": row.get("id")})
+                            for row in rows
+                        ],
+                        return_exceptions=True,
+                    )
+                    for row, resp in zip(rows, responses):
                         user_id = row.get("id")
-                        try:
-                            logger.info(f"Deleting user: {user_id}")
-                            resp = await async_api_request(
-                                "POST",
-                                "/admin/users/delete/",
-                                {"user_id": user_id},
-                            )
-                            logger.info(f"Delete response for user {user_id}: {resp}")
-                            
-                            if resp.get("success"):
-                                deleted_count += 1
-                                # Lưu message từ response (nếu có)
-                                if resp.get("message"):
-                                    last_msg = resp.get("message")
-                                    logger.info(f"Got message from backend: {last_msg}")
-                            else:
-                                error_msg = resp.get("message", "Không thể xóa user")
-                                errors.append(f"User {user_id}: {error_msg}")
-                                logger.warning(f"Failed to delete user {user_id}: {error_msg}")
-                        except Exception as e:
-                            logger.error(f"Error deleting user {user_id}: {e}", exc_info=True)
+                        if isinstance(resp, BaseException):
+                            logger.error(f"Error deleting user {user_id}: {resp}")
                             errors.append(f"User {user_id}: Lỗi khi xóa")
+                            continue
+                        logger.info(f"Delete response for user {user_id}: {resp}")
+                        if resp.get("success"):
+                            deleted_count += 1
+                            # Lưu message từ response (nếu có)
+                            if resp.get("message"):
+                                last_msg = resp.get("message")
+                        else:
+                            error_msg = resp.get("message", "Không thể xóa user")
+                            errors.append(f"User {user_id}: {error_msg}")
+                            logger.warning(f"Failed to delete user {user_id}: {error_msg}")
                     
                     logger.info(f"Delete completed. deleted_count={deleted_count}, errors={len(errors)}, last_msg={last_msg}")
                     
@@ -1949,26 +2522,30 @@ def admin_page():
                 last_msg = None
                 errors = []
                 
-                for row in rows:
-                    try:
-                        resp = await async_api_request(
+                # Fan-out các request xóa song song: N tài liệu tốn ~1 RTT thay vì N
+                responses = await asyncio.gather(
+                    *[
+                        async_api_request(
                             "POST",
                             "/admin/files/delete/",
-                            {
-                                "user_id": row.get("user_id"),
-                                "filename": row.get("filename"),
-                            },
+                            {"user_id": row.get("user_id"), "filename": row.get("filename")},
                         )
-                        if resp.get("success"):
-                            deleted_count += 1
-                            if resp.get("message"):
-                                last_msg = resp.get("message")
-                        else:
-                            error_msg = resp.get("message", "Không thể xóa tài liệu")
-                            errors.append(f"{row.get('filename')}: {error_msg}")
-                    except Exception as e:
-                        logger.error(f"Error deleting file {row.get('filename')}: {e}", exc_info=True)
+                        for row in rows
+                    ],
+                    return_exceptions=True,
+                )
+                for row, resp in zip(rows, responses):
+                    if isinstance(resp, BaseException):
+                        logger.error(f"Error deleting file {row.get('filename')}: {resp}")
                         errors.append(f"{row.get('filename')}: Lỗi khi xóa")
+                        continue
+                    if resp.get("success"):
+                        deleted_count += 1
+                        if resp.get("message"):
+                            last_msg = resp.get("message")
+                    else:
+                        error_msg = resp.get("message", "Không thể xóa tài liệu")
+                        errors.append(f"{row.get('filename')}: {error_msg}")
                 
                 # Hiển thị notification
                 if errors:
@@ -2075,11 +2652,13 @@ def profile_page():
         return
     render_navbar()
     user = session_state.user or {}
-    ui.markdown(
+    ui.html(
         f"""
-        ### Thông tin tài khoản
-        - Username: {user.get('username', '')}
-        - Email: {user.get('email', '')}
+        <h3 class='text-xl font-bold'>Thông tin tài khoản</h3>
+        <ul class='list-disc pl-6'>
+          <li>Username: {_escape(user.get('username', ''))}</li>
+          <li>Email: {_escape(user.get('email', ''))}</li>
+        </ul>
         """
     )
     ui.button("Đăng xuất", color="negative", on_click=handle_logout)
@@ -0,0 +1,72 @@
+"""
+Script CLI: in lịch sử chat của một hoặc nhiều user ra stdout dạng JSON.
+
+Usage:
+    python scripts/get_chat_history.py <user_id> [limit]
+    python scripts/get_chat_history.py <user_id1> <user_id2> ... [limit]
+
+Một user_id: in mảng JSON lịch sử của user đó.
+Nhiều user_id: in một object JSON {user_id: [messages...]}; Database chỉ
+khởi tạo một lần và các user được fetch song song qua thread pool, batch
+runner không phải trả giá handshake Mongo cho từng user.
+
+Dùng Database.get_chat_history_json: đọc BSON thô rồi serialize thẳng ra
+Extended JSON (relaxed), không decode từng document thành dict Python.
+"""
+import functools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+
+
+@functools.lru_cache(maxsize=1)
+def _db() -> Database:
+    """Database dùng chung cho cả lần chạy (share luôn MongoClient module-level)."""
+    return Database()
+
+
+def fetch_chat_history(user_id: str, limit: int = 50):
+    """Lấy lịch sử chat (cũ -> mới) của user dưới dạng list dict."""
+    return _db().get_chat_history(user_id, limit=limit)
+
+
+def main_batch(user_ids, limit: int = 50) -> str:
+    """Fetch lịch sử của nhiều user song song, ghép thành một object JSON."""
+    db = _db()
+    with ThreadPoolExecutor(max_workers=min(8, len(user_ids))) as pool:
+        payloads = list(pool.map(
+            lambda uid: db.get_chat_history_json(uid, limit=limit), user_ids
+        ))
+    # payload mỗi user đã là JSON sẵn - ghép chuỗi, không reparse
+    pairs = (f"{json.dumps(uid)}: {payload}" for uid, payload in zip(user_ids, payloads))
+    return "{" + ", ".join(pairs) + "}"
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        print(
+            "Usage: python scripts/get_chat_history.py <user_id> [<user_id> ...] [limit]",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    limit = 50
+    if len(args) >= 2 and args[-1].isdigit():
+        limit = int(args.pop())
+
+    if len(args) == 1:
+        output = _db().get_chat_history_json(args[0], limit=limit)
+    else:
+        output = main_batch(args, limit=limit)
+    sys.stdout.write(output)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,59 @@
 """
 Module xử lý authentication và session management
 """
+import base64
+import binascii
 import secrets
+import string
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict
 import logging
 import resend
 import os
 
-# Cấu hình Resend API Key
-resend.api_key = "re_JQk4fB5d_DztySKf3tqBCvx4mEPWp1Sjr"
+try:
+    from cachetools import TTLCache
+except ImportError:
+    TTLCache = None
+
+# Session trong memory sống tối đa 24h và tối đa 10k entry - server chạy dài
+# ngày không bị leak; hết hạn/tràn thì get_user_from_session tự restore từ DB
+_SESSION_TTL_SECONDS = 60 * 60 * 24
+_SESSION_MAXSIZE = 10_000
+
+# Cấu hình Resend API Key - đọc từ env thay vì hard-code trong source
+resend.api_key = os.getenv("RESEND_API_KEY", "")
+
+# Template email dựng sẵn một lần ở module scope; mỗi lần gửi chỉ substitute ${token}
+_RESET_EMAIL_TMPL = string.Template("""
+<div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+    <h2 style="color: #333;">Đặt lại mật khẩu</h2>
+    <p>Bạn đã yêu cầu đặt lại mật khẩu cho tài khoản RAGViet.</p>
+    <p>Mã OTP của bạn là:</p>
+    <div style="background-color: #f4f4f4; padding: 15px; text-align: center; font-size: 24px; font-weight: bold; letter-spacing: 5px; margin: 20px 0;">
+        ${token}
+    </div>
+    <p style="color: #666; font-size: 14px;">Mã này sẽ hết hạn sau 15 phút.</p>
+    <p style="color: #666; font-size: 14px;">Nếu bạn không yêu cầu đặt lại mật khẩu, vui lòng bỏ qua email này.</p>
+</div>
+""")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def _session_key(session_id: str) -> bytes:
+    """Chuyển session_id (base64 urlsafe) về bytes thô làm dict key.
+
+    Key bytes 16 byte hash nhanh hơn string 43 ký tự ở mỗi lần tra session.
+    Session_id cũ hoặc không decode được thì dùng chính chuỗi encode utf-8.
+    """
+    try:
+        return base64.urlsafe_b64decode(session_id + "=" * (-len(session_id) % 4))
+    except (binascii.Error, ValueError):
+        return session_id.encode("utf-8", "surrogateescape")
+
+
 class AuthManager:
     """Quản lý authentication và sessions"""
     
@@ -25,7 +65,13 @@ class AuthManager:
             database: Instance của Database class
         """
         self.db = database
-        self.sessions = {}
+        if TTLCache is not None:
+            self.sessions = TTLCache(maxsize=_SESSION_MAXSIZE, ttl=_SESSION_TTL_SECONDS)
+        else:
+            # cachetools chưa được cài: dict thường như cũ (không tự hết hạn)
+            self.sessions = {}
+        # Gửi email ở background để request không phải chờ Resend trả lời
+        self._mail_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mail")
         self._load_sessions_from_db()
     
     def register(self, username: str, email: str, password: str) -> Dict:
@@ -59,13 +105,18 @@ class AuthManager:
         
         user = self.db.verify_password(email, password)
         if user:
-            session_id = secrets.token_urlsafe(32)
+            # Sinh 16 byte thô làm dict key; client nhận bản base64 urlsafe
+            raw_key = secrets.token_bytes(16)
+            session_id = base64.urlsafe_b64encode(raw_key).rstrip(b"=").decode("ascii")
             user_data = {
                 "user_id": str(user["_id"]),
                 "username": user["username"],
                 "email": user["email"]
             }
-            self.sessions[session_id] = user_data
+            self.sessions[raw_key] = user_data
+            # Amortize việc dọn entry hết hạn vào mỗi lần login
+            if hasattr(self.sessions, "expire"):
+                self.sessions.expire()
             # Lưu session vào database để tồn tại sau khi reload
             self.db.save_auth_session(session_id, user_data["user_id"], user_data)
             logger.info(f"User đăng nhập: {user['email']}, session_id: {session_id}")
@@ -81,8 +132,9 @@ class AuthManager:
     
     def logout(self, session_id: str) -> bool:
         """Đăng xuất"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        key = _session_key(session_id)
+        if key in self.sessions:
+            del self.sessions[key]
         # Xóa session khỏi database
         self.db.delete_auth_session(session_id)
         return True
@@ -91,20 +143,21 @@ class AuthManager:
         """Lấy thông tin user từ session"""
         if not session_id:
             return None
+        key = _session_key(session_id)
         # Kiểm tra trong memory trước
-        if session_id in self.sessions:
-            return self.sessions[session_id]
+        if key in self.sessions:
+            return self.sessions[key]
         # Nếu không có trong memory, thử load từ database (trường hợp server restart)
         user_data = self.db.get_auth_session(session_id)
         if user_data:
             # Restore vào memory
-            self.sessions[session_id] = user_data
+            self.sessions[key] = user_data
             return user_data
         return None
-    
+
     def is_authenticated(self, session_id: Optional[str]) -> bool:
         """Kiểm tra user đã đăng nhập chưa"""
-        return session_id is not None and session_id in self.sessions
+        return session_id is not None and _session_key(session_id) in self.sessions
     
     def request_password_reset(self, email: str) -> Dict:
         """
@@ -118,8 +171,8 @@ class AuthManager:
         
         token = self.db.create_reset_token(email)
         if token:
-            # Kiểm tra API key
-            api_key = "re_JQk4fB5d_DztySKf3tqBCvx4mEPWp1Sjr"
+            # Kiểm tra API key (đọc từ env qua resend.api_key)
+            api_key = resend.api_key
             if not api_key:
                 return {
                     "success": False,
@@ -138,24 +191,22 @@ class AuthManager:
                     "from": "RagVietDocument@gmail.com",
                     "to": [email],
                     "subject": "Mã xác thực đặt lại mật khẩu - RAGViet",
-                    "html": f"""
-                    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                        <h2 style="color: #333;">Đặt lại mật khẩu</h2>
-                        <p>Bạn đã yêu cầu đặt lại mật khẩu cho tài khoản RAGViet.</p>
-                        <p>Mã OTP của bạn là:</p>
-                        <div style="background-color: #f4f4f4; padding: 15px; text-align: center; font-size: 24px; font-weight: bold; letter-spacing: 5px; margin: 20px 0;">
-                            {token}
-                        </div>
-                        <p style="color: #666; font-size: 14px;">Mã này sẽ hết hạn sau 15 phút.</p>
-                        <p style="color: #666; font-size: 14px;">Nếu bạn không yêu cầu đặt lại mật khẩu, vui lòng bỏ qua email này.</p>
-                    </div>
-                    """
+                    "html": _RESET_EMAIL_TMPL.substitute(token=token)
                 }
                 
+                # Fire-and-forget: submit vào thread pool rồi trả lời ngay,
+                # request không bị treo theo RTT của Resend
+                def _log_mail_result(fut, email=email):
+                    try:
+                        resp = fut.result()
+                        logger.info(f"✅ Đã gửi email reset password đến {email}. Response: {resp}")
+                    except Exception as e:
+                        logger.error(f"❌ Lỗi khi gửi email đến {email}: {str(e)}")
+
                 logger.info(f"Đang gửi email đến {email} với API key: {api_key[:10]}...")
-                email_resp = resend.Emails.send(params)
-                logger.info(f"✅ Đã gửi email reset password đến {email}. Response: {email_resp}")
-                
+                future = self._mail_executor.submit(resend.Emails.send, params)
+                future.add_done_callback(_log_mail_result)
+
                 return {
                     "success": True,
                     "message": "Mã OTP đã được gửi đến email của bạn. Vui lòng kiểm tra."
@@ -163,23 +214,10 @@ class AuthManager:
             except Exception as e:
                 error_msg = str(e)
                 logger.error(f"❌ Lỗi khi gửi email đến {email}: {error_msg}")
-                
-                # Xử lý các lỗi cụ thể
-                if "API key is invalid" in error_msg or "invalid" in error_msg.lower():
-                    return {
-                        "success": False,
-                        "message": "API key không hợp lệ. Vui lòng kiểm tra lại cấu hình tại https://resend.com/api-keys"
-                    }
-                elif "domain" in error_msg.lower():
-                    return {
-                        "success": False,
-                        "message": "Domain email chưa được xác thực. Vui lòng liên hệ quản trị viên."
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "message": f"Không thể gửi email: {error_msg}"
-                    }
+                return {
+                    "success": False,
+                    "message": f"Không thể gửi email: {error_msg}"
+                }
         else:
             return {"success": False, "message": "Email không tồn tại trong hệ thống"}
     
@@ -206,7 +244,7 @@ class AuthManager:
         """Tải lại tất cả sessions từ database khi khởi động"""
         try:
             sessions = self.db.load_all_auth_sessions()
-            self.sessions.update(sessions)
+            self.sessions.update({_session_key(sid): data for sid, data in sessions.items()})
             logger.info(f"Đã tải {len(sessions)} sessions từ database")
         except Exception as e:
             logger.error(f"Lỗi khi tải sessions từ database: {str(e)}")
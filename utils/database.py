@@ -6,50 +6,173 @@ from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, DuplicateKeyError
 from typing import Optional, Dict, List, Any
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+import atexit
+import functools
 import hashlib
 import secrets
-from bson import ObjectId
+import threading
+import time
+import weakref
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import InsertOne
+from pymongo.write_concern import WriteConcern
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cost factor cho bcrypt - 12 rounds ~100ms/lần hash trên CPU hiện tại
+_BCRYPT_ROUNDS = 12
+
+# TTL cho cache kết quả verify_password: user gõ lại mật khẩu liên tục trong
+# cửa sổ này chỉ tốn một lần KDF + một lần find_one
+_VERIFY_TTL_SECONDS = 30
+
+# Buffer chat message rồi bulk_write: mỗi lượt chat không tốn một RTT insert riêng
+_CHAT_FLUSH_INTERVAL = 0.5  # giây
+_CHAT_FLUSH_BATCH = 50
+
+
+def _hash_password(password: str) -> str:
+    """Hash mật khẩu bằng bcrypt; fallback SHA-256 nếu bcrypt chưa được cài."""
+    if bcrypt is not None:
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=_BCRYPT_ROUNDS)).decode()
+    logger.warning("bcrypt chưa được cài - fallback SHA-256 (kém an toàn hơn)")
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def _check_password(password: str, stored_hash: str) -> bool:
+    """So khớp mật khẩu với hash đã lưu (bcrypt hoặc SHA-256 legacy)."""
+    if stored_hash.startswith("$2") and bcrypt is not None:
+        try:
+            return bcrypt.checkpw(password.encode(), stored_hash.encode())
+        except ValueError:
+            return False
+    # Hash legacy SHA-256 hex - so sánh constant-time
+    return secrets.compare_digest(
+        hashlib.sha256(password.encode()).hexdigest(), stored_hash
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_dt(dt: datetime) -> str:
+    """Format một datetime về ISO 8601 UTC hậu tố Z (memoize - timestamp
+    lặp lại nhiều lần trong một history, vd cặp user/assistant chung giờ)."""
+    # Naive coi như UTC; chỉ astimezone khi thực sự khác múi giờ
+    if dt.tzinfo is not None and dt.tzinfo is not timezone.utc:
+        dt = dt.astimezone(timezone.utc)
+    return f"{dt.strftime('%Y-%m-%dT%H:%M:%S')}.{dt.microsecond // 1000:03d}Z"
+
 
 def _format_timestamp(value: Optional[Any]) -> Optional[str]:
     """Đưa timestamp về ISO 8601 (UTC) với hậu tố Z."""
     if value is None:
         return None
     if isinstance(value, datetime):
-        dt = value
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        else:
-            dt = dt.astimezone(timezone.utc)
-        return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        return _format_dt(value)
     return str(value)
 
 
+def _iso_date_expr(field: str) -> Dict:
+    """Biểu thức $dateToString format ISO 8601 Z, null-safe - format ngay
+    trong Mongo (C) thay vì lặp _format_timestamp từng document ở Python.
+
+    onError trả về str(value) như fallback cũ của _format_timestamp, một
+    document legacy có timestamp không phải Date không làm sập cả pipeline.
+    """
+    return {"$dateToString": {
+        "date": field,
+        "format": "%Y-%m-%dT%H:%M:%S.%LZ",
+        "timezone": "UTC",
+        "onNull": None,
+        "onError": {"$toString": field},
+    }}
+
+
+# MongoClient dùng chung cho mọi Database instance: client của pymongo
+# thread-safe và tự quản connection pool, mở client mới mỗi instance chỉ tốn
+# thêm RTT khởi động (đáng kể với CLI script gọi Database() mỗi lần chạy)
+_shared_client: Optional[MongoClient] = None
+_indexes_created = False
+
+# atexit flush đăng ký MỘT lần cho cả process trên weakref của các instance
+# còn sống - đăng ký bound method trong __init__ sẽ pin từng instance vĩnh
+# viễn (Database() được tạo mỗi request ở api/authentication.py)
+_instances: "weakref.WeakSet[Database]" = weakref.WeakSet()
+_atexit_registered = False
+
+
+def _flush_all_chat_buffers() -> None:
+    """Flush buffer chat của mọi Database instance còn sống khi shutdown."""
+    for db in list(_instances):
+        try:
+            db.flush_chat_buffer()
+        except Exception as e:
+            logger.error(f"Lỗi khi flush chat buffer lúc shutdown: {str(e)}")
+
+
 class Database:
     """Quản lý kết nối MongoDB và các operations"""
-    
+
     def __init__(self):
         """Khởi tạo kết nối MongoDB"""
+        global _shared_client, _indexes_created, _atexit_registered
+
         self.mongo_uri = os.getenv("MONGO_URI")
         self.db_name = os.getenv("MONGODB_DB_NAME", "ragviet")
-        
+
         if not self.mongo_uri:
             logger.error("MONGO_URI không được cấu hình trong .env")
             raise ValueError("MONGO_URI không được cấu hình")
-        
+
+        # (email, digest mật khẩu) -> (hết hạn lúc, user đã bỏ hash hoặc None)
+        self._verify_cache: Dict = {}
+
+        # Buffer insert chat history, flush theo batch/timer (xem save_chat_message)
+        self._chat_buffer: List[Dict] = []
+        self._chat_lock = threading.Lock()
+        self._chat_flush_timer: Optional[threading.Timer] = None
+        _instances.add(self)
+        if not _atexit_registered:
+            atexit.register(_flush_all_chat_buffers)
+            _atexit_registered = True
+
         try:
-            self.client = MongoClient(self.mongo_uri)
+            if _shared_client is None:
+                # Không ping: MongoClient lazy-connect, ping chỉ serialize startup
+                _shared_client = MongoClient(
+                    self.mongo_uri,
+                    maxPoolSize=int(os.getenv("MONGO_POOL", "50")),
+                    minPoolSize=5,
+                    serverSelectionTimeoutMS=3000,
+                    retryWrites=True,
+                    appname="ragviet",
+                )
+            self.client = _shared_client
             self.db = self.client[self.db_name]
-            # Test connection
-            self.client.admin.command('ping')
+            # View raw BSON của chat_history: đọc để re-serialize JSON không
+            # cần decode từng document thành dict (xem get_chat_history_json)
+            self._raw_chat = self.db.chat_history.with_options(
+                codec_options=CodecOptions(document_class=RawBSONDocument)
+            )
+            # View w=0 cho flush chat buffer: insert fire-and-forget, không
+            # chờ ack - auth/user vẫn ghi w=1 qua self.db như cũ
+            self._chat_w0 = self.db.chat_history.with_options(
+                write_concern=WriteConcern(w=0)
+            )
             logger.info(f"Đã kết nối MongoDB: {self.db_name}")
-            
-            # Tạo indexes
-            self._create_indexes()
+
+            # Tạo indexes một lần cho cả process, không phải mỗi instance
+            if not _indexes_created:
+                self._create_indexes()
+                _indexes_created = True
         except ConnectionFailure as e:
             logger.error(f"Không thể kết nối MongoDB: {str(e)}")
             raise
@@ -60,21 +183,30 @@ class Database:
         self.db.users.create_index("email", unique=True)
         self.db.users.create_index("username", unique=True)
         
-        # Index cho chat_history collection
-        self.db.chat_history.create_index("user_id")
+        # Index cho chat_history collection - compound (user_id, ...) đã phục
+        # vụ luôn query theo prefix user_id, không cần index đơn lẻ
         self.db.chat_history.create_index([("user_id", 1), ("timestamp", -1)])
-        
-        # Index cho chat_sessions collection
-        self.db.chat_sessions.create_index("user_id")
-        self.db.chat_sessions.create_index([("user_id", 1), ("created_at", -1)])
+        # get_session_messages: find({session_id}).sort(timestamp, 1)
+        self.db.chat_history.create_index([("session_id", 1), ("timestamp", 1)])
+        # TTL retention 90 ngày: Mongo tự dọn history cũ ở background,
+        # không bao giờ phải delete hàng loạt ở foreground
+        self.db.chat_history.create_index(
+            "timestamp", expireAfterSeconds=60 * 60 * 24 * 90
+        )
+
+        # Index cho chat_sessions collection - khớp sort updated_at của
+        # get_chat_sessions để Mongo không phải sort in-memory
+        self.db.chat_sessions.create_index([("user_id", 1), ("updated_at", -1)])
         self.db.chat_sessions.create_index("session_id", unique=True)
-        
-        # Index cho auth_sessions collection
+
+        # Index cho auth_sessions collection - TTL expires_at để collection
+        # bounded theo số session còn sống, load_all_auth_sessions không
+        # phải quét session tích lũy từ thuở khai thiên
         self.db.auth_sessions.create_index("session_id", unique=True)
         self.db.auth_sessions.create_index("user_id")
-        
+        self.db.auth_sessions.create_index("expires_at", expireAfterSeconds=0)
+
         # Index cho user_files collection
-        self.db.user_files.create_index("user_id")
         self.db.user_files.create_index([("user_id", 1), ("filename", 1)], unique=True)
         self.db.user_files.create_index("filename")
         
@@ -94,8 +226,8 @@ class Database:
         """
         try:
             # Hash password
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
-            
+            password_hash = _hash_password(password)
+
             user = {
                 "username": username,
                 "email": email.lower(),
@@ -119,7 +251,11 @@ class Database:
     def get_user_by_email(self, email: str) -> Optional[Dict]:
         """Lấy user theo email"""
         try:
-            user = self.db.users.find_one({"email": email.lower()})
+            # Không kéo hash/token nhạy cảm về - caller không cần tới
+            user = self.db.users.find_one(
+                {"email": email.lower()},
+                projection={"password_hash": 0, "reset_token": 0, "reset_token_expires": 0},
+            )
             if user:
                 user["_id"] = str(user["_id"])
                 return user
@@ -127,11 +263,14 @@ class Database:
         except Exception as e:
             logger.error(f"Lỗi khi lấy user: {str(e)}")
             return None
-    
+
     def get_user_by_username(self, username: str) -> Optional[Dict]:
         """Lấy user theo username"""
         try:
-            user = self.db.users.find_one({"username": username})
+            user = self.db.users.find_one(
+                {"username": username},
+                projection={"password_hash": 0, "reset_token": 0, "reset_token_expires": 0},
+            )
             if user:
                 user["_id"] = str(user["_id"])
                 return user
@@ -147,14 +286,49 @@ class Database:
         Returns:
             User document nếu đúng, None nếu sai
         """
-        user = self.get_user_by_email(email)
-        if not user:
+        # Cache TTL ngắn: login lặp lại trong cửa sổ chỉ tốn dict lookup,
+        # không KDF (bcrypt ~100ms) cũng không find_one
+        cache_key = (email.lower(), hashlib.sha256(password.encode()).digest())
+        now = time.monotonic()
+        if len(self._verify_cache) > 1024:
+            # Dọn các entry hết hạn để cache không phình vô hạn
+            self._verify_cache = {
+                k: v for k, v in self._verify_cache.items() if now < v[0]
+            }
+        cached = self._verify_cache.get(cache_key)
+        if cached and now < cached[0]:
+            return dict(cached[1]) if cached[1] is not None else None
+
+        # Projection chỉ kéo các field cần cho login thay vì nguyên document
+        try:
+            user = self.db.users.find_one(
+                {"email": email.lower()},
+                projection={"password_hash": 1, "username": 1, "email": 1, "is_active": 1},
+            )
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy user: {str(e)}")
             return None
-        
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
-        if user.get("password_hash") == password_hash:
+        if not user or user.get("is_active") is False:
+            self._verify_cache[cache_key] = (now + _VERIFY_TTL_SECONDS, None)
+            return None
+        user["_id"] = str(user["_id"])
+
+        stored_hash = user.get("password_hash") or ""
+        if _check_password(password, stored_hash):
+            # Hash legacy SHA-256: nâng cấp trong suốt lên bcrypt ở lần login đúng
+            if bcrypt is not None and not stored_hash.startswith("$2"):
+                try:
+                    self.db.users.update_one(
+                        {"email": email.lower()},
+                        {"$set": {"password_hash": _hash_password(password)}},
+                    )
+                    logger.info(f"Đã nâng cấp password hash lên bcrypt cho {email}")
+                except Exception as e:
+                    logger.warning(f"Không thể nâng cấp password hash: {str(e)}")
             user.pop("password_hash", None)
+            self._verify_cache[cache_key] = (now + _VERIFY_TTL_SECONDS, dict(user))
             return user
+        self._verify_cache[cache_key] = (now + _VERIFY_TTL_SECONDS, None)
         return None
     
     def create_reset_token(self, email: str) -> Optional[str]:
@@ -164,22 +338,26 @@ class Database:
         Returns:
             Reset token hoặc None
         """
-        user = self.get_user_by_email(email)
+        # Generate 4-digit OTP, hết hạn sau 15 phút (khớp nội dung email)
+        token = f"{secrets.randbelow(10000):04d}"
+        expires_at = datetime.utcnow() + timedelta(minutes=15)
+
+        # find_one_and_update atomic: một RTT thay vì find_one + update_one
+        try:
+            user = self.db.users.find_one_and_update(
+                {"email": email.lower()},
+                {"$set": {
+                    "reset_token": token,
+                    "reset_token_expires": expires_at
+                }},
+                projection={"_id": 1},
+            )
+        except Exception as e:
+            logger.error(f"Lỗi khi tạo reset token: {str(e)}")
+            return None
         if not user:
             return None
-        
-        # Generate 4-digit OTP
-        token = str(secrets.randbelow(10000)).zfill(4)
-        expires_at = datetime.utcnow().replace(hour=23, minute=59, second=59)
-        
-        self.db.users.update_one(
-            {"email": email.lower()},
-            {"$set": {
-                "reset_token": token,
-                "reset_token_expires": expires_at
-            }}
-        )
-        
+
         logger.info(f"Đã tạo reset OTP cho: {email}")
         return token
     
@@ -203,9 +381,14 @@ class Database:
         user = self.verify_reset_token(token)
         if not user:
             return False
-        
-        password_hash = hashlib.sha256(new_password.encode()).hexdigest()
-        
+
+        password_hash = _hash_password(new_password)
+        # Mật khẩu đổi rồi thì kết quả verify cũ của email này không còn giá trị
+        email_key = (user.get("email") or "").lower()
+        self._verify_cache = {
+            k: v for k, v in self._verify_cache.items() if k[0] != email_key
+        }
+
         result = self.db.users.update_one(
             {"reset_token": token},
             {"$set": {
@@ -243,13 +426,54 @@ class Database:
                 "session_id": session_id,
                 "timestamp": datetime.utcnow()
             }
-            
-            self.db.chat_history.insert_one(chat_entry)
+
+            # Buffer rồi bulk_write thay vì insert_one mỗi message: burst chat
+            # chỉ tốn một RTT cho cả batch. Reader gọi flush trước nên
+            # read-after-write vẫn nhất quán.
+            with self._chat_lock:
+                self._chat_buffer.append(chat_entry)
+                need_flush = len(self._chat_buffer) >= _CHAT_FLUSH_BATCH
+                if not need_flush and self._chat_flush_timer is None:
+                    timer = threading.Timer(
+                        _CHAT_FLUSH_INTERVAL,
+                        self.flush_chat_buffer,
+                        kwargs={"acknowledged": False},
+                    )
+                    timer.daemon = True
+                    self._chat_flush_timer = timer
+                    timer.start()
+            if need_flush:
+                self.flush_chat_buffer(acknowledged=False)
             logger.info(f"Đã lưu chat message cho user: {user_id}")
             return True
         except Exception as e:
             logger.error(f"Lỗi khi lưu chat history: {str(e)}")
             return False
+
+    def flush_chat_buffer(self, acknowledged: bool = True) -> None:
+        """Đẩy các chat message đang buffer xuống Mongo bằng một bulk_write.
+
+        acknowledged=True (mặc định, các reader gọi trước khi đọc): chờ ack
+        w=1 để read-after-write nhất quán. Flush nền theo timer/batch dùng
+        acknowledged=False (w=0) vì không có read nào đợi ngay sau đó.
+        """
+        with self._chat_lock:
+            batch = self._chat_buffer
+            self._chat_buffer = []
+            timer = self._chat_flush_timer
+            self._chat_flush_timer = None
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return
+        try:
+            coll = self.db.chat_history if acknowledged else self._chat_w0
+            coll.bulk_write(
+                [InsertOne(doc) for doc in batch], ordered=False
+            )
+            logger.info(f"Đã flush {len(batch)} chat message xuống Mongo")
+        except Exception as e:
+            logger.error(f"Lỗi khi bulk flush chat history: {str(e)}")
     
     def get_chat_history(self, user_id: str, limit: int = 50) -> List[Dict]:
         """
@@ -263,24 +487,75 @@ class Database:
             List các chat messages
         """
         try:
-            messages = list(self.db.chat_history.find(
-                {"user_id": user_id}
-            ).sort("timestamp", -1).limit(limit))
-            
-            for msg in messages:
-                msg["_id"] = str(msg["_id"])
-                msg["timestamp"] = _format_timestamp(msg["timestamp"])
-            
-            return list(reversed(messages))  # Trả về theo thứ tự cũ -> mới
+            # Đảm bảo message vừa buffer đã xuống DB trước khi đọc
+            self.flush_chat_buffer()
+            # Aggregation: projection hẹp dùng index (user_id, timestamp) và
+            # format _id/timestamp ngay server-side, không hậu xử lý Python
+            messages = list(self.db.chat_history.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"timestamp": -1}},
+                {"$limit": limit},
+                {"$project": {
+                    "_id": {"$toString": "$_id"},
+                    "message": 1,
+                    "response": 1,
+                    "selected_file": 1,
+                    "timestamp": _iso_date_expr("$timestamp"),
+                }},
+            ]))
+
+            messages.reverse()  # Trả về theo thứ tự cũ -> mới, đảo in-place
+            return messages
         except Exception as e:
             logger.error(f"Lỗi khi lấy chat history: {str(e)}")
             return []
-    
+
+    def get_chat_history_json(self, user_id: str, limit: int = 50) -> str:
+        """
+        Lấy lịch sử chat của user dưới dạng chuỗi JSON (Extended JSON relaxed).
+
+        Đọc qua view RawBSONDocument nên không dựng dict Python cho từng
+        document - dành cho caller chỉ cần in/ghi JSON ra ngoài (CLI script,
+        export), không cần thao tác trên từng field.
+        """
+        try:
+            self.flush_chat_buffer()
+            docs = list(self._raw_chat.find(
+                {"user_id": user_id},
+                projection={"message": 1, "response": 1, "selected_file": 1, "timestamp": 1},
+            ).sort("timestamp", -1).limit(limit))
+            docs.reverse()  # cũ -> mới, giống get_chat_history
+            return json_util.dumps(
+                docs, ensure_ascii=False, json_options=json_util.RELAXED_JSON_OPTIONS
+            )
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy chat history (json): {str(e)}")
+            return "[]"
+
+
     def clear_chat_history(self, user_id: str) -> bool:
-        """Xóa lịch sử chat của user"""
+        """Xóa lịch sử chat của user (xóa theo lô để không giữ write lock lâu)"""
         try:
-            result = self.db.chat_history.delete_many({"user_id": user_id})
-            logger.info(f"Đã xóa {result.deleted_count} messages của user: {user_id}")
+            # Flush trước để message đang buffer cũng bị xóa theo
+            self.flush_chat_buffer()
+            # delete_many không có limit - chunk bằng cách lấy _id theo lô
+            # rồi xóa theo $in, user chat nhiều không khóa collection một lần dài
+            batch = 1000
+            deleted = 0
+            while True:
+                ids = [
+                    doc["_id"]
+                    for doc in self.db.chat_history.find(
+                        {"user_id": user_id}, {"_id": 1}
+                    ).limit(batch)
+                ]
+                if not ids:
+                    break
+                result = self.db.chat_history.delete_many({"_id": {"$in": ids}})
+                deleted += result.deleted_count
+                if len(ids) < batch:
+                    break
+            logger.info(f"Đã xóa {deleted} messages của user: {user_id}")
             return True
         except Exception as e:
             logger.error(f"Lỗi khi xóa chat history: {str(e)}")
@@ -327,15 +602,19 @@ class Database:
             List các chat sessions
         """
         try:
-            sessions = list(self.db.chat_sessions.find(
-                {"user_id": user_id}
-            ).sort("updated_at", -1).limit(limit))
-            
-            for session in sessions:
-                session["_id"] = str(session["_id"])
-                session["created_at"] = _format_timestamp(session["created_at"])
-                session["updated_at"] = _format_timestamp(session["updated_at"])
-            
+            sessions = list(self.db.chat_sessions.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"updated_at": -1}},
+                {"$limit": limit},
+                {"$project": {
+                    "_id": {"$toString": "$_id"},
+                    "session_id": 1,
+                    "title": 1,
+                    "message_count": 1,
+                    "created_at": _iso_date_expr("$created_at"),
+                    "updated_at": _iso_date_expr("$updated_at"),
+                }},
+            ]))
             return sessions
         except Exception as e:
             logger.error(f"Lỗi khi lấy chat sessions: {str(e)}")
@@ -352,14 +631,20 @@ class Database:
             List các messages
         """
         try:
-            messages = list(self.db.chat_history.find(
-                {"session_id": session_id}
-            ).sort("timestamp", 1))
-            
-            for msg in messages:
-                msg["_id"] = str(msg["_id"])
-                msg["timestamp"] = _format_timestamp(msg["timestamp"])
-            
+            # Đảm bảo message vừa buffer đã xuống DB trước khi đọc
+            self.flush_chat_buffer()
+            messages = list(self.db.chat_history.aggregate([
+                {"$match": {"session_id": session_id}},
+                {"$sort": {"timestamp": 1}},
+                {"$project": {
+                    "_id": {"$toString": "$_id"},
+                    "message": 1,
+                    "response": 1,
+                    "selected_file": 1,
+                    "session_id": 1,
+                    "timestamp": _iso_date_expr("$timestamp"),
+                }},
+            ]))
             return messages
         except Exception as e:
             logger.error(f"Lỗi khi lấy session messages: {str(e)}")
@@ -415,6 +700,8 @@ class Database:
             session_id: ID của session
         """
         try:
+            # Đảm bảo message vừa buffer đã xuống DB trước khi đọc
+            self.flush_chat_buffer()
             message = self.db.chat_history.find_one(
                 {"session_id": session_id},
                 sort=[("timestamp", -1)]
@@ -443,7 +730,8 @@ class Database:
                 "username": user_data.get("username"),
                 "email": user_data.get("email"),
                 "created_at": datetime.utcnow(),
-                "expires_at": None  # Sessions không hết hạn, có thể thêm logic hết hạn sau
+                # TTL index trên expires_at để Mongo tự dọn session cũ
+                "expires_at": datetime.utcnow() + timedelta(days=30)
             }
             
             # Update nếu đã tồn tại, insert nếu chưa có
@@ -469,7 +757,10 @@ class Database:
             User data nếu session hợp lệ, None nếu không
         """
         try:
-            session = self.db.auth_sessions.find_one({"session_id": session_id})
+            session = self.db.auth_sessions.find_one(
+                {"session_id": session_id},
+                projection={"user_id": 1, "username": 1, "email": 1, "_id": 0},
+            )
             if session:
                 return {
                     "user_id": str(session["user_id"]),
@@ -504,7 +795,10 @@ class Database:
             Dict {session_id: user_data}
         """
         try:
-            sessions = self.db.auth_sessions.find({})
+            sessions = self.db.auth_sessions.find(
+                {},
+                projection={"session_id": 1, "user_id": 1, "username": 1, "email": 1, "_id": 0},
+            )
             result = {}
             for session in sessions:
                 session_id = session["session_id"]
@@ -540,13 +834,33 @@ class Database:
         }
         """
         try:
-            sessions = self.get_chat_sessions(user_id, limit=limit_sessions)
+            # Đảm bảo message vừa buffer đã xuống DB trước khi đọc
+            self.flush_chat_buffer()
+            # Một pipeline $lookup duy nhất thay cho 1 + N query (một
+            # get_session_messages cho mỗi session); sort dùng index
+            # (session_id, timestamp) phía server
+            sessions = self.db.chat_sessions.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"updated_at": -1}},
+                {"$limit": limit_sessions},
+                {"$lookup": {
+                    "from": "chat_history",
+                    "let": {"sid": "$session_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$session_id", "$$sid"]}}},
+                        {"$sort": {"timestamp": 1}},
+                        {"$project": {"message": 1, "response": 1, "timestamp": 1}},
+                    ],
+                    "as": "raw_messages",
+                }},
+                {"$project": {"session_id": 1, "created_at": 1, "updated_at": 1,
+                              "raw_messages": 1}},
+            ])
             result_sessions: List[Dict] = []
 
             for session in sessions:
                 session_id = session["session_id"]
-                # Lấy toàn bộ messages của session (theo thứ tự thời gian)
-                raw_messages = self.get_session_messages(session_id)
+                raw_messages = session.get("raw_messages", [])
 
                 messages: List[Dict] = []
                 last_user_question: Optional[str] = None
@@ -572,7 +886,10 @@ class Database:
                         })
                 
                 title = last_user_question or "Cuộc trò chuyện mới"
-                last_message_ts = messages[-1]["timestamp"] if messages else session.get("updated_at")
+                last_message_ts = (
+                    messages[-1]["timestamp"] if messages
+                    else _format_timestamp(session.get("updated_at"))
+                )
 
                 result_sessions.append({
                     "session_id": session_id,
@@ -641,10 +958,18 @@ class Database:
             List các file documents
         """
         try:
-            files = list(self.db.user_files.find({"user_id": user_id}).sort("uploaded_at", -1))
-            for file in files:
-                file["_id"] = str(file["_id"])
-                file["uploaded_at"] = _format_timestamp(file.get("uploaded_at"))
+            files = list(self.db.user_files.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$sort": {"uploaded_at": -1}},
+                {"$project": {
+                    "_id": {"$toString": "$_id"},
+                    "filename": 1,
+                    "total_chunks": 1,
+                    "cloudinary_url": 1,
+                    "cloudinary_public_id": 1,
+                    "uploaded_at": _iso_date_expr("$uploaded_at"),
+                }},
+            ]))
             return files
         except Exception as e:
             logger.error(f"Lỗi khi lấy danh sách files: {str(e)}")